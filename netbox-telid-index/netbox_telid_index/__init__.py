@@ -0,0 +1,18 @@
+# Плагин без моделей и интерфейса - только миграция с индексами по
+# custom_field_data->>'tel_id' для tenancy_contact и tenancy_contactgroup.
+# Установка: pip install ./netbox-telid-index, затем в configuration.py
+#	PLUGINS = ['netbox_telid_index']
+# и manage.py migrate netbox_telid_index
+from netbox.plugins import PluginConfig
+
+
+class TelIdIndexConfig(PluginConfig):
+    name = 'netbox_telid_index'
+    verbose_name = 'tel_id index'
+    description = "Индексы по полю tel_id для Contact и ContactGroup"
+    version = '0.1.0'
+    base_url = 'telid-index'
+    min_version = '4.2.0'
+
+
+config = TelIdIndexConfig
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+TEL_ID = 'tel_id'	# наименование поля - идентификатора привязки (как в netbox_contacts.py)
+TABLES = ('tenancy_contact', 'tenancy_contactgroup')
+
+
+def index_sql(table):		# индекс по выражению - используется запросами вида custom_field_data->>'tel_id' = ...
+    return (
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_{TEL_ID}_idx ON {table} ((custom_field_data->>'{TEL_ID}'));",
+        f"DROP INDEX CONCURRENTLY IF EXISTS {table}_{TEL_ID}_idx;",
+    )
+
+
+class Migration(migrations.Migration):
+    atomic = False		# CONCURRENTLY - без блокировки таблиц на запись, но вне транзакции
+
+    dependencies = [
+        ('tenancy', '__first__'),
+    ]
+
+    operations = [
+        migrations.RunSQL(*index_sql(table)) for table in TABLES
+    ]
@@ -1,10 +1,55 @@
 import requests
+import gzip
+import hashlib
+import json
+import random
 import re
-from extras.scripts import Script, BooleanVar, StringVar
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models.fields.json import KeyTextTransform
+from django.utils import timezone
+from core.choices import ObjectChangeActionChoices
+from core.models import ObjectChange
+from extras.scripts import Script, BooleanVar, ChoiceVar, StringVar, TextVar, IntegerVar
 from tenancy.models import Contact, ContactGroup
 from extras.models import CustomField
+from netbox.search.backends import search_backend
+from utilities.exceptions import AbortScript
+
+# с 'ijson' выгрузка разбирается потоком, по записям; без него - целиком через json
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 TEL_ID = 'tel_id'	# наименование поля - идентификатора привязки
+BULK_CHUNK = 500	# размер пакета для bulk-операций с БД
+BENCH_PREFIX = 'bench:'	# пространство tel_id синтетического справочника замеров
+SNAPSHOT_PREFIX = 'contacts.snapshot.'	# ключ отпечатков прошлого запуска в кэше (+ хэш URL)
+HTTP_TIMEOUT = (5, 60)	# таймауты соединения и чтения, сек
+HTTP_RETRIES = 3	# повторы запроса при сбоях соединения и ответах 5xx
+HTTP_BACKOFF = 1.0	# множитель паузы между повторами, сек
+NO_PARENT = ('0', '', None)	# str_parent корневых подразделений
+
+# поля записей справочника, изменение которых нужно переносить в netbox
+STR_FIELDS = ('str_name', 'str_parent', 'adres', 'mail')
+PPL_FIELDS = ('str_id', 'ppl_fio', 'dlg_name', 'ppl_tel', 'ppl_cab')
+
+# изменяемые скриптом поля (для bulk_update)
+GROUP_FIELDS = ['name', 'slug', 'parent', 'description', 'custom_field_data', 'last_updated']
+CONTACT_FIELDS = ['name', 'title', 'group', 'address', 'phone', 'custom_field_data', 'last_updated']
 
 # Подразделение - словарь: {
 #	'str_id': '831',	идентификатор записи в тел.справочнике
@@ -22,7 +67,246 @@ TEL_ID = 'tel_id'	# наименование поля - идентификато
 #	'ppl_cab': '407'
 #}
 
+
+class Directory:
+    """Выгрузка тел.справочника с индексами для поиска: строятся один раз на запуск."""
+
+    def __init__(self, response):
+        self.str = response['str']
+        self.ppl = response['ppl']
+        self.str_by_id = {}			# str_id -> подразделение (первое, как при линейном поиске)
+        self.str_by_name = defaultdict(list)	# str_name -> [подразделения]
+        for item in self.str:
+            self.str_by_id.setdefault(item['str_id'], item)
+            self.str_by_name[item['str_name']].append(item)
+        self.ppl_by_id = {}			# ppl_id -> сотрудник
+        self.ppl_by_fio = defaultdict(list)	# ppl_fio -> [сотрудники]
+        for item in self.ppl:
+            self.ppl_by_id.setdefault(item['ppl_id'], item)
+            self.ppl_by_fio[item['ppl_fio']].append(item)
+        self.order_str()
+
+# подразделения по уровням иерархии str_parent: родитель всегда раньше потомков.
+# Корни - записи с вышестоящим, которого нет в выгрузке ('0' или потерянный - orphans),
+# не достижимые от корней записи замкнуты в цикл (cycles)
+    def order_str(self):
+        children = defaultdict(list)
+        level = []
+        self.str_orphans = []
+        for item in self.str_by_id.values():
+            if item['str_parent'] in self.str_by_id:
+                children[item['str_parent']].append(item)
+            else:
+                level.append(item)
+                if item['str_parent'] not in NO_PARENT:
+                    self.str_orphans.append(item)
+        self.str_levels = []
+        while level:
+            self.str_levels.append(level)
+            level = [child for item in level for child in children[item['str_id']]]
+        seen = {item['str_id'] for level in self.str_levels for item in level}
+        self.str_cycles = [item for item in self.str_by_id.values() if item['str_id'] not in seen]
+        self.str_ordered = [item for level in self.str_levels for item in level]
+
+
+def cache_key(url):			# ключ данных прошлого запуска в кэше
+    return SNAPSHOT_PREFIX + hashlib.md5(str(url).encode()).hexdigest()
+
+
+class Fetcher:
+    """Загрузка выгрузки справочника: условный запрос, gzip, таймауты и повторы, потоковый разбор.
+
+    Валидаторы ответа (ETag, Last-Modified) запоминаются в кэше только после
+    успешного запуска - иначе ответ 304 скрыл бы недоделанную работу.
+    """
+
+    LISTS = {				# списки выгрузки и нужные из записей поля
+        'str': ('str_id',) + STR_FIELDS,
+        'ppl': ('ppl_id',) + PPL_FIELDS,
+    }
+
+    def __init__(self, url, kinds, scope=None):	# scope - весь набор источников: при его смене 304 не доверяем
+        self.url = str(url)
+        self.kinds = sorted(kinds)
+        self.key = cache_key(scope or url) + '.http.' + hashlib.md5(self.url.encode()).hexdigest()
+        self.validators = {}		# валидаторы полученного ответа
+        self.session = requests.Session()
+        retry = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF,
+                      status_forcelist=(500, 502, 503, 504), allowed_methods=('GET',))
+        self.session.mount('http://', HTTPAdapter(max_retries=retry))
+        self.session.mount('https://', HTTPAdapter(max_retries=retry))
+
+    def fetch(self, conditional=True):	# выгрузка {'str': [...], 'ppl': [...]} или None, если не изменилась (304)
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        saved = cache.get(self.key) or {}
+        if conditional and set(self.kinds) <= set(saved.get('kinds', ())):	# прошлый запуск смотрел те же списки
+            if saved.get('etag'):
+                headers['If-None-Match'] = saved['etag']
+            if saved.get('last_modified'):
+                headers['If-Modified-Since'] = saved['last_modified']
+        with self.session.get(self.url, headers=headers, timeout=HTTP_TIMEOUT, stream=True) as resp:
+            if resp.status_code == 304:
+                return None
+            resp.raise_for_status()
+            self.validators = {'etag': resp.headers.get('ETag'), 'last_modified': resp.headers.get('Last-Modified')}
+            if ijson is None:
+                return self.trim(resp.json())
+            resp.raw.decode_content = True		# распаковка gzip при чтении потока
+            return self.parse(resp.raw)
+
+    def trim(self, response):		# оставляем только нужные поля записей
+        return {kind: [{field: item.get(field) for field in fields} for item in response.get(kind, [])]
+                for kind, fields in self.LISTS.items()}
+
+    def parse(self, stream):		# потоковый разбор: в памяти только нужные поля уже разобранных записей
+        result = {kind: [] for kind in self.LISTS}
+        item, kind = None, None
+        for prefix, event, value in ijson.parse(stream):
+            if item is None:
+                if event == 'start_map' and prefix.endswith('.item') and prefix[:-5] in result:
+                    item, kind = {}, prefix[:-5]
+            elif event == 'end_map' and prefix == kind + '.item':
+                result[kind].append(item)
+                item = None
+            elif event in ('string', 'number', 'boolean', 'null'):
+                field = prefix[len(kind) + 6:]		# kind.item.field
+                if field in self.LISTS[kind]:
+                    item[field] = value if value is None or isinstance(value, str) else str(value)
+        return result
+
+    def save(self):			# запоминаем валидаторы после успешного запуска
+        if any(self.validators.values()):
+            cache.set(self.key, dict(self.validators, kinds=self.kinds), None)
+        else:
+            cache.delete(self.key)
+
+
+# Несколько справочников: id записей второго и следующих получают префикс 'хост:',
+# первый - без префикса (совместимость с уже перенесенными tel_id)
+def source_prefixes(urls):
+    prefixes = []
+    for n, url in enumerate(urls):
+        prefix = ''
+        if n:
+            host = urlsplit(url).netloc or url
+            prefix = f'{host}:' if f'{host}:' not in prefixes else f'{host}.{n}:'
+        prefixes.append(prefix)
+    return prefixes
+
+
+def merge_sources(responses, prefixes):	# объединенная выгрузка с id в пространствах имен источников
+    def ns(prefix, value):
+        return value if not prefix or value in NO_PARENT else f'{prefix}{value}'
+    merged = {'str': [], 'ppl': []}
+    for response, prefix in zip(responses, prefixes):
+        if not prefix:
+            merged['str'].extend(response['str'])
+            merged['ppl'].extend(response['ppl'])
+            continue
+        merged['str'].extend(dict(item, str_id=ns(prefix, item['str_id']), str_parent=ns(prefix, item['str_parent']))
+                             for item in response['str'])
+        merged['ppl'].extend(dict(item, ppl_id=ns(prefix, item['ppl_id']), str_id=ns(prefix, item['str_id']))
+                             for item in response['ppl'])
+    return merged
+
+
+def fingerprint(item, fields):		# короткий хэш значимых полей записи
+    text = '\x1f'.join(str(item.get(field) or '') for field in fields)
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+
+class Snapshot:
+    """Отпечатки записей справочника с прошлого успешного запуска - хранятся в кэше.
+
+    Отдельно хранится общий хэш каждого списка: если выгрузка не менялась,
+    достаточно прочитать только его, без отпечатков по записям.
+    """
+
+    KINDS = {'str': STR_FIELDS, 'ppl': PPL_FIELDS}
+
+    def __init__(self, url, directory):
+        self.key = cache_key(url)
+        self.new = {
+            'str': {str_id: fingerprint(item, STR_FIELDS) for str_id, item in directory.str_by_id.items()},
+            'ppl': {ppl_id: fingerprint(item, PPL_FIELDS) for ppl_id, item in directory.ppl_by_id.items()},
+        }
+        self.digests = {kind: self.digest(prints) for kind, prints in self.new.items()}
+        self._old = None
+
+    def digest(self, prints):
+        h = hashlib.blake2b(digest_size=16)
+        for key in sorted(prints):
+            h.update(f'{key}={prints[key]};'.encode())
+        return h.hexdigest()
+
+    def unchanged(self, kinds):		# True - выгрузка по этим спискам та же, что в прошлый раз
+        old = cache.get(self.key + '.digest') or {}
+        return all(old.get(kind) == self.digests[kind] for kind in kinds)
+
+    @property
+    def old(self):			# отпечатки прошлого запуска - читаются только при изменениях
+        if self._old is None:
+            self._old = cache.get(self.key) or {}
+        return self._old
+
+    def known(self, kind):
+        return kind in self.old
+
+    def changed(self, kind):		# новые и измененные записи
+        old = self.old.get(kind, {})
+        return {key for key, value in self.new[kind].items() if old.get(key) != value}
+
+    def removed(self, kind):		# исчезнувшие из справочника записи
+        return set(self.old.get(kind, {})) - set(self.new[kind])
+
+    def save(self, kinds, failed):	# сохраняем обработанные списки; неудачные записи останутся измененными
+        prints = dict(self.old)
+        digests = dict(cache.get(self.key + '.digest') or {})
+        for kind in kinds:
+            old = self.old.get(kind, {})
+            new = dict(self.new[kind])
+            for key in failed.get(kind, ()):
+                if key in new:
+                    new.pop(key)		# без отпечатка запись в следующий раз снова новая - даже если не менялась
+                elif key in old:
+                    new[key] = old[key]	# исчезнувшая запись снова окажется исчезнувшей
+            prints[kind] = new
+            digests[kind] = self.digest(new)
+        cache.set(self.key, prints, None)
+        cache.set(self.key + '.digest', digests, None)
+
+
+class QueryCounter:
+    """Счетчик SQL-запросов соединения: connection.execute_wrapper(QueryCounter())."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Changes:
+    """Новые, измененные и удаляемые объекты одного типа - собираются до записи в БД."""
+
+    def __init__(self):
+        self.create = []
+        self.update = {}		# pk -> объект
+        self.delete = {}		# pk -> объект
+
+    def __bool__(self):
+        return bool(self.create or self.update or self.delete)
+
+    def touch(self, obj):		# объект будет изменен: снимок прежнего состояния для журнала - до первого изменения
+        if obj.pk and obj.pk not in self.update:
+            if hasattr(obj, 'snapshot'):
+                obj.snapshot()
+            self.update[obj.pk] = obj
+
+
 class ContactImport(Script):
+    id_prefix = ''		# сверять только объекты с tel_id из этого пространства (для замеров)
     # можно отключить разные блоки импорта
     ImportOrg = BooleanVar(
         label="Смотреть структуру?",
@@ -35,13 +319,17 @@ class ContactImport(Script):
         description="Включить просмотр сотрудников",
     )
     # установка URL тел.справочника
-    API_URL = StringVar(
-        max_length=50,
-        label="Адрес справочника",
+    API_URL = TextVar(
+        label="Адреса справочников",
         default="http://telefon.head.adm/exp.php",
-        description="Укажите адрес источника данных для программного доступа",
+        description="Адреса источников данных для программного доступа - по одному в строке; id второго и следующих получают префикс 'хост:'",
         required=True,
     )
+    FullCheck = BooleanVar(
+        label="Полная проверка?",
+        default=False,
+        description="Сверять все записи, а не только изменившиеся с прошлого запуска",
+    )
 
     class Meta:
         name = "Contacts import script"
@@ -50,7 +338,34 @@ class ContactImport(Script):
         job_timeout = 300
 
     def run(self, data, commit):
+        self.queries = QueryCounter()
+        self.stats = {}				# фаза -> время, запросы, пик памяти
+        with connection.execute_wrapper(self.queries):
+            result = self.import_directory(data, commit)
+        self.log_info(f"Всего запросов к БД: {self.queries.count}; {self.stats_text()}")
+        return result
 
+# замер фазы импорта: время и число запросов суммируются по фазе; пик памяти - если включен tracemalloc
+    @contextmanager
+    def phase(self, name):
+        stat = self.stats.setdefault(name, {'time': 0.0, 'queries': 0, 'peak': 0})
+        queries, start = self.queries.count, time.perf_counter()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            stat['time'] += time.perf_counter() - start
+            stat['queries'] += self.queries.count - queries
+            if tracemalloc.is_tracing():
+                stat['peak'] = max(stat['peak'], tracemalloc.get_traced_memory()[1])
+
+    def stats_text(self):
+        return ', '.join(f"{name}: {stat['time']:.2f} s, {stat['queries']} q"
+                         + (f", {stat['peak'] / 2**20:.1f} MB" if stat['peak'] else '')
+                         for name, stat in self.stats.items())
+
+    def import_directory(self, data, commit):
         try:
             tel_id = CustomField.objects.get(name=TEL_ID)	# проверка нужного для работы CustomField
         except:
@@ -58,201 +373,705 @@ class ContactImport(Script):
             return
 #        self.log_debug(tel_id)
 
-        try:		# запрос в телефонный справочник
-            response = requests.get(str(data['API_URL'])).json()	# забираем сразу всё
-        except:
-            self.log_failure(f"Ошибка получения данных. Проверьте адрес источника: {data['API_URL']}")
+        kinds = [kind for kind, on in (('str', data['ImportOrg']), ('ppl', data['ImportPerson'])) if on]
+        urls = [url for url in re.split(r'[\s,;]+', str(data['API_URL'])) if url]
+        if not urls:
+            self.log_failure(f"Не указан адрес справочника")
+            return
+        fetchers = [Fetcher(url, kinds, ' '.join(urls)) for url in urls]
+        with self.phase('fetch'):
+            responses = self.fetch_all(fetchers, conditional=not data['FullCheck'])
+        if responses is None:
+            return
+        if all(response is None for response in responses):
+            self.log_info(f"Справочник не изменился с прошлого запуска (HTTP 304).")
+            return
+        if any(response is None for response in responses):	# для сверки нужны все источники целиком
+            stale = [fetcher for fetcher, response in zip(fetchers, responses) if response is None]
+            with self.phase('fetch'):
+                refetched = iter(self.fetch_all(stale, conditional=False) or ())
+            responses = [response if response is not None else next(refetched, None) for response in responses]
+            if any(response is None for response in responses):
+                return
+        with self.phase('index'):
+            response = merge_sources(responses, source_prefixes(urls))
+            self.log_debug(f"список структур: {len(response['str'])}, список должностей: {len(response['ppl'])}")
+            directory = Directory(response)		# индексы по id и именам
+            snapshot = Snapshot(' '.join(urls), directory)	# отпечатки записей для сравнения с прошлым запуском
+            unchanged = not data['FullCheck'] and snapshot.unchanged(kinds)
+        if unchanged:
+            self.log_info(f"Справочник не изменился с прошлого запуска.")
+            if commit:
+                for fetcher in fetchers:
+                    fetcher.save()
             return
-        self.log_debug(f"список структур: {len(response['str'])}, список должностей: {len(response['ppl'])}")
+        self.failed_ids = {'str': set(), 'ppl': set()}	# записи, которые не удалось перенести
+        self.saved = True
+        self.touched = set()				# группы, созданные, перенесенные или удаленные в этом запуске
+        with self.phase('load'):
+            self.load_groups()				# группы из справочника: {tel_id: группа}
 
         if data['ImportOrg']:
-            self.log_info(f"Проверка существующих групп.")
-            for grp in ContactGroup.objects.all():		# сначала обновляем подразделения
-                if grp.cf[TEL_ID]:				# только перенесенные из справочника
-                    self.manage_grp(commit, grp, response['str'])
-            self.log_info(f"Обновление структуры по справочнику.")
-            for org in response['str']:
-                self.manage_org(commit, org)			# добавляем недостающие
+            groups = Changes()
+            orgs = directory.str_ordered			# родители раньше потомков
+            replan = None					# None - сверяем все записи
+            gone = set(self.groups) - set(directory.str_by_id)	# разность множеств id: исчезнувшие группы
+            self.log_debug(f"Уровней структуры: {len(directory.str_levels)}")
+            for org in directory.str_orphans:
+                self.log_warning(f"Нет вышестоящего подразделения id={org['str_parent']} для id={org['str_id']} {org['str_name']}: добавляем в корень")
+            for org in directory.str_cycles:
+                self.log_failure(f"Циклическая подчиненность подразделения id={org['str_id']} {org['str_name']} (parent={org['str_parent']}): пропускаем")
+                self.failed_ids['str'].add(org['str_id'])
+            if not data['FullCheck'] and snapshot.known('str'):	# только изменившиеся с прошлого запуска
+                removed, changed = snapshot.removed('str'), snapshot.changed('str')
+                gone &= removed
+                replan = changed
+                self.log_debug(f"Изменения структуры: новых/измененных {len(changed)}, исчезнувших {len(removed)}")
+            with self.phase('plan'):
+                self.log_info(f"Проверка существующих групп.")
+                fresh = [org for org in orgs if (replan is None or org['str_id'] in replan) and org['str_id'] not in self.groups]
+                moves, deletes, ambiguous = self.match_gone('str', self.groups, gone, fresh, 'str_name')
+                for grp, org in moves:				# сначала обновляем подразделения
+                    self.manage_grp(grp, org, groups)
+                for grp in deletes:
+                    self.manage_grp(grp, None, groups)
+                self.report_ambiguous("Группы", ambiguous)
+                self.log_info(f"Обновление структуры по справочнику.")
+                for org in orgs:				# изменившиеся и потомки затронутых в этом запуске
+                    if replan is None or org['str_id'] in replan or self.depends(org['str_parent']):
+                        self.manage_org(org, groups)	# добавляем недостающие
+            with self.phase('write'):
+                self.apply_groups(commit, groups)
 
         if data['ImportPerson']:
-            self.log_info(f"Проверка существующих контактов.")
-            for cont in Contact.objects.all():			# обновляем сотрудников
-                if cont.cf[TEL_ID]:				# только перенесенные из справочника
-                    self.manage_cont(commit, cont, response['ppl'])
-            self.log_info(f"Обновление контактов по справочнику.")
-            for sotr in response['ppl']:
-                self.manage_person(commit, sotr)		# добавляем новых
+            contacts = Changes()
+            sotrs = directory.ppl
+            if not data['FullCheck'] and snapshot.known('ppl'):	# только изменившиеся с прошлого запуска
+                removed, changed = snapshot.removed('ppl'), snapshot.changed('ppl')
+                changed |= {sotr['ppl_id'] for sotr in sotrs if self.depends(sotr['str_id'])}	# и сотрудники затронутых групп
+                with self.phase('load'):
+                    self.load_contacts(removed | changed)	# только их и читаем из БД - по индексу tel_id
+                gone = set(self.contacts) & removed
+                sotrs = [sotr for sotr in sotrs if sotr['ppl_id'] in changed]
+                self.log_debug(f"Изменения состава: новых/измененных {len(changed)}, исчезнувших {len(removed)}")
+            else:
+                with self.phase('load'):
+                    self.load_contacts()
+                gone = set(self.contacts) - set(directory.ppl_by_id)	# разность множеств id: исчезнувшие контакты
+            with self.phase('plan'):
+                self.log_info(f"Проверка существующих контактов.")
+                fresh = [sotr for sotr in sotrs if sotr['ppl_fio'] and sotr['ppl_id'] not in self.contacts]
+                moves, deletes, ambiguous = self.match_gone('ppl', self.contacts, gone, fresh, 'ppl_fio')
+                for cont, sotr in moves:			# обновляем сотрудников
+                    self.manage_cont(cont, sotr, contacts)
+                for cont in deletes:
+                    self.manage_cont(cont, None, contacts)
+                self.report_ambiguous("Контакты", ambiguous)
+                self.log_info(f"Обновление контактов по справочнику.")
+                for sotr in sotrs:
+                    self.manage_person(sotr, contacts)		# добавляем новых
+            with self.phase('write'):
+                self.apply_contacts(commit, contacts)
 
+        if commit and self.saved:			# при ошибке записи отпечатки не сохраняем - повторим всё
+            with self.phase('write'):
+                snapshot.save(kinds, self.failed_ids)
+                if not any(self.failed_ids.values()):	# 304 только если всё перенесено
+                    for fetcher in fetchers:
+                        fetcher.save()
         return
 
+# одновременный запрос всех справочников: время - как у самого медленного.
+# None вместо списка - ошибка (без любого из источников сверять нельзя - удалим чужие записи)
+    def fetch_all(self, fetchers, conditional=True):
+        with ThreadPoolExecutor(max_workers=len(fetchers)) as pool:
+            futures = [pool.submit(fetcher.fetch, conditional) for fetcher in fetchers]
+        responses = []
+        for fetcher, future in zip(fetchers, futures):
+            try:
+                responses.append(future.result())
+            except Exception as e:
+                self.log_failure(f"Ошибка получения данных. Проверьте адрес источника: {fetcher.url} ({e})")
+                return None
+        return responses
+
     def make_slug(self, grp_id):		# уникальный URL-friendly идентификатор для создаваемых групп
-        return f'grp{grp_id}'
+        return 'grp' + re.sub(r'[^-a-zA-Z0-9_]', '-', str(grp_id))
 
     def make_description(self, adres, mail):	# описание группы составляем из адреса и эл.почты
         return f"{str(adres) if adres else ''}{'; Email: '+str(mail) if mail else ''}"	# Null не допускается, только пустые строки
 
+    def tel_id(self, obj):			# не obj.cf - там запрос описания полей на каждый объект
+        return obj.custom_field_data.get(TEL_ID)
+
+# все группы одним запросом: перенесенные из справочника - в словарь по tel_id,
+# имена всех - для проверки уникальности (parent, name) до записи
+    def load_groups(self):
+        self.groups = {}
+        self.group_names = set()
+        for grp in ContactGroup.objects.all():
+            self.group_names.add(self.unique_key(grp.parent_id, grp.name))
+            if self.tel_id(grp) and str(self.tel_id(grp)).startswith(self.id_prefix):
+                self.groups.setdefault(self.tel_id(grp), grp)
+
+# контакты из справочника: все или только с нужными tel_id. Отбор по custom_field_data->>'tel_id'
+# использует индекс плагина netbox_telid_index; имена всех контактов - только значения, без объектов
+    def load_contacts(self, ids=None):
+        self.contacts = {}
+        self.contact_names = {self.unique_key(group_id, name) for group_id, name in Contact.objects.values_list('group_id', 'name')}
+        contacts = Contact.objects.annotate(tel=KeyTextTransform(TEL_ID, 'custom_field_data')).filter(tel__isnull=False)
+        if self.id_prefix:
+            contacts = contacts.filter(tel__startswith=self.id_prefix)
+        if ids is not None:
+            contacts = contacts.filter(tel__in=list(ids))
+        for cont in contacts:
+            if self.tel_id(cont):
+                self.contacts.setdefault(self.tel_id(cont), cont)
+
+    def unique_key(self, parent, name):		# для новых (еще не записанных) групп - по объекту
+        if parent is None or isinstance(parent, int):
+            return (parent, name)
+        return (parent.pk or id(parent), name)
+
+# занять новое сочетание (родитель, имя) вместо старого; False - уже занято другим объектом
+    def claim_name(self, names, old_key, new_key):
+        if new_key == old_key:
+            return True
+        if new_key in names:
+            return False
+        names.discard(old_key)
+        names.add(new_key)
+        return True
+
+    def set_group_id(self, grp, grp_id):	# смена tel_id группы - и в словаре групп
+        old_id = self.tel_id(grp)
+        if self.groups.get(old_id) is grp:
+            del self.groups[old_id]
+        grp.custom_field_data[TEL_ID] = grp_id
+        self.groups[grp_id] = grp
+
+    def set_contact_id(self, cont, ppl_id):	# смена tel_id контакта - и в словаре контактов
+        old_id = self.tel_id(cont)
+        if self.contacts.get(old_id) is cont:
+            del self.contacts[old_id]
+        cont.custom_field_data[TEL_ID] = ppl_id
+        self.contacts[ppl_id] = cont
+
     def find_parent(self, grp_id):		# поиск вышестоящей группы (если есть)
-        try:
-            parent = ContactGroup.objects.get(custom_field_data = dict({TEL_ID:grp_id}))
-        except ContactGroup.DoesNotExist:
-            parent = None
-        return parent
-
-    def find_org_name(self, org_name, struct):	# поиск групп по имени в тел.справочнике (если есть)
-        t2s = []				# возвращаем список
-        for item in struct:
-            if org_name == item['str_name']:
-                t2s.append(item)
-        return t2s
-
-    def find_pers_name(self, p_name, struct):	# поиск человека по имени в тел.справочнике (если есть)
-        t2s = []				# возвращаем список
-        for item in struct:
-            if p_name == item['ppl_fio']:
-                t2s.append(item)
-        return t2s
-
-    def get_item(self, collection, key, target):	# поиск в списке словарей по ключу
-        return next((item for item in collection if item[key] == target), False)
-
-    def manage_grp(self, commit, grp, struct):		# обработка группы в netbox
-#        self.log_debug(f"Группа: id={grp.cf[TEL_ID]}, {grp.name}")
-        n_org = self.get_item(struct, 'str_id', grp.cf[TEL_ID])	# ищем группу по id в справочнике
-        if not n_org:						# удалена из структуры
-            self.log_debug(f"Группа: id={grp.cf[TEL_ID]} {grp.name} не найдена!")
-            t_grp = self.find_org_name(grp.name, struct)	# ищем группу по имени в справочнике (список)
-            if len(t_grp) == 0:
-                self.log_success(f"Удаляем группу !!! id={grp.cf[TEL_ID]} {grp.name}")
-                if commit:
-                    try:
-                        grp.delete()
-                    except:
-                        self.log_failure(f"Ошибка удаления группы id={grp.cf[TEL_ID]} {grp.name}")
-            elif len(t_grp) == 1:	# подразделение переподчинили
-                self.log_debug(f"Найдена группа: id={t_grp[0]['str_id']}, {t_grp[0]['str_name']}.")
-                if ((grp.cf[TEL_ID] != t_grp[0]['str_id']) or (grp.parent != self.find_parent(t_grp[0]['str_parent']))):
-                    self.log_success(f"Обновляем группу: id={grp.cf[TEL_ID]} {grp.name} -> ID: {t_grp[0]['str_id']}, Parent: {t_grp[0]['str_parent']}")
-                    if commit:
-                        if grp.pk and hasattr(grp, 'snapshot'):
-                            grp.snapshot()			# запись для истории изменений
-                        grp.custom_field_data = dict({TEL_ID:t_grp[0]['str_id']})
-                        grp.parent = self.find_parent(t_grp[0]['str_parent'])
-                        grp.full_clean()
-                        grp.save()
-            elif len(t_grp) > 1:	# есть несколько новых подразделений с такими же именами - что делать?
-                id2s = []
-                for item in t_grp:
-                    id2s.append(item['str_id'])
-                self.log_warning(f"Найдены группы {grp.name}: {id2s}")
-        return
+        return self.groups.get(grp_id)
+
+    def depends(self, grp_id):			# группа создана, перенесена, удалена или не записана в этом запуске - сверяем зависящие от нее
+        return grp_id in self.touched or grp_id in self.failed_ids['str']
+
+# запись без вышестоящей группы кладется в корень и сверяется в следующий раз - группа может появиться
+    def check_parent(self, kind, item_id, parent_id, parent):
+        if parent is None and parent_id not in NO_PARENT:
+            self.failed_ids[kind].add(item_id)
+
+# исчезнувшие из справочника объекты (множество id gone) сопоставляются по имени с новыми записями fresh:
+# имя у одного исчезнувшего и одной новой записи - перенос на новый id, нет новых - удаление,
+# остальное неоднозначно - в общий отчет
+    def match_gone(self, kind, objects, gone, fresh, name_field):
+        gone_by_name = defaultdict(list)
+        for obj_id in gone:
+            if obj_id in objects:
+                gone_by_name[objects[obj_id].name].append(objects[obj_id])
+        fresh_by_name = defaultdict(list)
+        for item in fresh:
+            fresh_by_name[item[name_field]].append(item)
+        moves, deletes, ambiguous = [], [], []
+        for name, objs in gone_by_name.items():
+            items = fresh_by_name.get(name, [])
+            if not items:
+                deletes.extend(objs)
+            elif len(objs) == 1 and len(items) == 1:
+                moves.append((objs[0], items[0]))
+            else:
+                ambiguous.append(f"{name}: {[self.tel_id(obj) for obj in objs]} -> {[item[kind + '_id'] for item in items]}")
+                for obj in objs:
+                    self.failed_ids[kind].add(self.tel_id(obj))	# проверим и в следующий раз
+        return moves, deletes, ambiguous
+
+    def report_ambiguous(self, what, ambiguous):	# один отчет вместо предупреждения на каждый объект
+        if ambiguous:
+            self.log_warning(f"{what}: неоднозначных совпадений по имени {len(ambiguous)}, оставлены без изменений: "
+                             + '; '.join(ambiguous))
+
+    def manage_grp(self, grp, unit, changes):		# исчезнувшая группа: перенос на запись unit или удаление (unit=None)
+        if unit is None:
+            self.log_success(f"Удаляем группу !!! id={self.tel_id(grp)} {grp.name}")
+            changes.delete[grp.pk] = grp
+            self.groups.pop(self.tel_id(grp), None)
+            self.touched.add(self.tel_id(grp))
+            return
+        self.log_debug(f"Найдена группа: id={unit['str_id']}, {unit['str_name']}.")	# подразделение переподчинили
+        parent = self.find_parent(unit['str_parent'])
+        self.check_parent('str', unit['str_id'], unit['str_parent'], parent)
+        if not self.claim_name(self.group_names, self.unique_key(grp.parent, grp.name), self.unique_key(parent, grp.name)):
+            self.log_failure(f"Ошибка обновления группы id={self.tel_id(grp)} {grp.name}: такое имя уже есть в {parent}")
+            self.failed_ids['str'].add(self.tel_id(grp))
+            return
+        self.log_success(f"Обновляем группу: id={self.tel_id(grp)} {grp.name} -> ID: {unit['str_id']}, Parent: {unit['str_parent']}")
+        changes.touch(grp)			# запись для истории изменений
+        self.set_group_id(grp, unit['str_id'])
+        grp.parent = parent
+        self.touched.add(unit['str_id'])
 
-    def manage_org(self, commit, unit):			# обработка группы в тел.справочнике
+    def manage_org(self, unit, changes):			# обработка группы в тел.справочнике
 #        self.log_debug(f"Подразделение: id={unit['str_id']}, {unit['str_name']}")
-        try:
-            grp = ContactGroup.objects.get(custom_field_data = dict({TEL_ID:unit['str_id']}))
-            self.log_debug(f"Найдена группа: id={grp.cf[TEL_ID]} {grp.name}, Parent: {grp.parent}, Desc: {grp.description}")
+        grp = self.groups.get(unit['str_id'])
 # значения из тел.справочника
-            tel_grp = [ unit['str_name'], self.make_slug(unit['str_id']), self.find_parent(unit['str_parent']), self.make_description(unit['adres'], unit['mail']) ]
+        tel_grp = [ unit['str_name'], self.make_slug(unit['str_id']), self.find_parent(unit['str_parent']), self.make_description(unit['adres'], unit['mail']) ]
+        self.check_parent('str', unit['str_id'], unit['str_parent'], tel_grp[2])
+        if grp:
+            self.log_debug(f"Найдена группа: id={self.tel_id(grp)} {grp.name}, Parent: {grp.parent}, Desc: {grp.description}")
             if (grp.name != tel_grp[0]) or (grp.slug != tel_grp[1]) or (grp.parent != tel_grp[2]) or (grp.description != tel_grp[3]):
-                self.log_success(f"Обновляем группу: id={grp.cf[TEL_ID]} {tel_grp[0]}, Parent: {tel_grp[2]}, Desc: {tel_grp[3]}")
-                if commit:
-                    if grp.pk and hasattr(grp, 'snapshot'):
-                        grp.snapshot()				# запись для истории изменений
-                    grp.name = tel_grp[0]
-                    grp.slug = tel_grp[1]
-                    grp.parent = tel_grp[2]
-                    grp.description = tel_grp[3]
-                    grp.full_clean()
-                    grp.save()
-        except ContactGroup.DoesNotExist:
+                if not self.claim_name(self.group_names, self.unique_key(grp.parent, grp.name), self.unique_key(tel_grp[2], tel_grp[0])):
+                    self.log_failure(f"Ошибка обновления группы id={self.tel_id(grp)} {tel_grp[0]}: такое имя уже есть в {tel_grp[2]}")
+                    self.failed_ids['str'].add(unit['str_id'])
+                    return
+                self.log_success(f"Обновляем группу: id={self.tel_id(grp)} {tel_grp[0]}, Parent: {tel_grp[2]}, Desc: {tel_grp[3]}")
+                changes.touch(grp)				# запись для истории изменений
+                if grp.parent != tel_grp[2]:
+                    self.touched.add(unit['str_id'])
+                grp.name = tel_grp[0]
+                grp.slug = tel_grp[1]
+                grp.parent = tel_grp[2]
+                grp.description = tel_grp[3]
+        else:
             new_gpr = ContactGroup(
-                name = unit['str_name'],
-                slug = self.make_slug(unit['str_id']),
-                parent = self.find_parent(unit['str_parent']),
-                description = self.make_description(unit['adres'], unit['mail']),
+                name = tel_grp[0],
+                slug = tel_grp[1],
+                parent = tel_grp[2],
+                description = tel_grp[3],
                 custom_field_data = dict({TEL_ID:unit['str_id']}),	# ключевое поле
+                lft = 0, rght = 0, tree_id = 0, level = 0,		# дерево MPTT перестраивается после bulk_create
                 )
+            if not self.claim_name(self.group_names, None, self.unique_key(new_gpr.parent, new_gpr.name)):
+                self.log_failure(f"Ошибка создания ContactGroup {new_gpr.name} в группе {new_gpr.parent}: такое имя уже есть")
+                self.failed_ids['str'].add(unit['str_id'])
+                return
             self.log_success(f"Добавляем новую группу: id={unit['str_id']} {unit['str_name']}")
-            if commit:
-                try:
-                    new_gpr.full_clean()
-                    new_gpr.save()
-                except:
-                    self.log_failure(f"Ошибка создания ContactGroup {new_grp.name} в группе {new_grp.parent}")
+            changes.create.append(new_gpr)
+            self.groups[unit['str_id']] = new_gpr		# новая группа может быть родителем следующих
+            self.touched.add(unit['str_id'])
         return
 
     def make_phone(self, tel_num):		# очищаем номер телефона - только цифры
         return re.sub(r'\D', '', tel_num)
 
-    def manage_person(self, commit, sotr):
+    def manage_person(self, sotr, changes):
 #        self.log_debug(f"Сотрудник: id={sotr['ppl_id']}, {sotr['ppl_fio']}")
         if not sotr['ppl_fio']:		# вакансии без ФИО не записываем
             return
-        try:
-            pers = Contact.objects.get(custom_field_data = dict({TEL_ID:sotr['ppl_id']}))
-            self.log_debug(f"Найден сотрудник: id={pers.cf[TEL_ID]} {pers.name}, Group: {pers.group}, Title: {pers.title}")
+        pers = self.contacts.get(sotr['ppl_id'])
 # значения из тел.справочника
-            ppl = [ sotr['ppl_fio'], sotr['dlg_name'], self.find_parent(sotr['str_id']), sotr['ppl_cab'], self.make_phone(sotr['ppl_tel']) ]
+        ppl = [ sotr['ppl_fio'], sotr['dlg_name'], self.find_parent(sotr['str_id']), sotr['ppl_cab'], self.make_phone(sotr['ppl_tel']) ]
+        self.check_parent('ppl', sotr['ppl_id'], sotr['str_id'], ppl[2])
+        if pers:
+            self.log_debug(f"Найден сотрудник: id={self.tel_id(pers)} {pers.name}, Group: {pers.group}, Title: {pers.title}")
             if (pers.name != ppl[0]) or (pers.title != ppl[1]) or (pers.group != ppl[2]) or (pers.address != ppl[3]) or (pers.phone != ppl[4]):
-                self.log_success(f"Обновляем сотрудника: id={pers.cf[TEL_ID]} {ppl[0]}, Group: {ppl[2]}, Title: {ppl[1]}, Addr: {ppl[3]}, Phone: {ppl[4]}")
-                if commit:
-                    if pers.pk and hasattr(pers, 'snapshot'):
-                        pers.snapshot()				# запись для истории изменений
-                    pers.name = ppl[0]
-                    pers.title = ppl[1]
-                    pers.group = ppl[2]
-                    pers.address = ppl[3]
-                    pers.phone = ppl[4]
-                    pers.full_clean()
-                    pers.save()
-        except Contact.DoesNotExist:
+                if not self.claim_name(self.contact_names, self.unique_key(pers.group, pers.name), self.unique_key(ppl[2], ppl[0])):
+                    self.log_failure(f"Ошибка обновления контакта id={self.tel_id(pers)} {ppl[0]}: такой контакт уже есть в {ppl[2]}")
+                    self.failed_ids['ppl'].add(sotr['ppl_id'])
+                    return
+                self.log_success(f"Обновляем сотрудника: id={self.tel_id(pers)} {ppl[0]}, Group: {ppl[2]}, Title: {ppl[1]}, Addr: {ppl[3]}, Phone: {ppl[4]}")
+                changes.touch(pers)				# запись для истории изменений
+                pers.name = ppl[0]
+                pers.title = ppl[1]
+                pers.group = ppl[2]
+                pers.address = ppl[3]
+                pers.phone = ppl[4]
+        else:
             new_pers = Contact(
-                name = sotr['ppl_fio'],
-                title = sotr['dlg_name'],
-                group = self.find_parent(sotr['str_id']),
-                address = sotr['ppl_cab'],
-                phone = self.make_phone(sotr['ppl_tel']),
+                name = ppl[0],
+                title = ppl[1],
+                group = ppl[2],
+                address = ppl[3],
+                phone = ppl[4],
                 custom_field_data = dict({TEL_ID:sotr['ppl_id']}),	# ключевое поле
                 )
+            if not self.claim_name(self.contact_names, None, self.unique_key(new_pers.group, new_pers.name)):
+                self.log_failure(f"Ошибка создания Contact {new_pers.name} в группе {new_pers.group}: такой контакт уже есть")
+                self.failed_ids['ppl'].add(sotr['ppl_id'])
+                return
             self.log_success(f"Добавляем сотрудника: id={sotr['ppl_id']} {sotr['ppl_fio']} в {sotr['str_id']}")
-            if commit:
-                try:
-                    new_pers.full_clean()
-                    new_pers.save()
-                except:
-                    self.log_failure(f"Ошибка создания Contact {new_pers.name} в группе {new_pers.group}")
+            changes.create.append(new_pers)
+            self.contacts[sotr['ppl_id']] = new_pers
         return
 
-    def manage_cont(self, commit, cont, tel_list):
-#        self.log_debug(f"Контакт: id={cont.cf[TEL_ID]}, {cont.name}")
-        pers = self.get_item(tel_list, 'ppl_id', cont.cf[TEL_ID])	# ищем человека по id в справочнике
-        if not pers:
-            self.log_debug(f"Контакт: id={cont.cf[TEL_ID]} {cont.name} не найден!")
-            names = self.find_pers_name(cont.name, tel_list)		# ищем по имени контакта в справочнике (список)
-            if len(names) == 0:
-                self.log_success(f"Удаляем контакт !!! id={cont.cf[TEL_ID]} {cont.name}")
-                if commit:
-                    try:
-                        cont.delete()
-                    except:
-                        self.log_failure(f"Ошибка удаления контакта id={cont.cf[TEL_ID]} {cont.name}")
-            elif len(names) == 1:	# сотрудника перевели в другое подразделение
-                self.log_debug(f"Найден сотрудник: id={names[0]['ppl_id']}, {names[0]['ppl_fio']}.")
-                if ((cont.cf[TEL_ID] != names[0]['ppl_id']) or (cont.group != self.find_parent(names[0]['str_id']))):
-                    self.log_success(f"Обновляем контакт: id={cont.cf[TEL_ID]} {cont.name} grp={cont.group} -> ID: {names[0]['ppl_id']}, Parent: {names[0]['str_id']}")
-                    if commit:
-                        try:
-                            if cont.pk and hasattr(cont, 'snapshot'):
-                                cont.snapshot()			# запись для истории изменений
-                            cont.custom_field_data = dict({TEL_ID:names[0]['ppl_id']})
-                            cont.group = self.find_parent(names[0]['str_id'])
-                            cont.full_clean()
-                            cont.save()
-                        except:
-                            self.log_failure(f"Ошибка обновления контакта id={cont.cf[TEL_ID]} {cont.name} grp={cont.group}")
-            elif len(names) > 1:	# есть несколько новых с такими же ФИО - что делать?
-                id2s = []
-                for item in names:
-                    id2s.append(item['ppl_id'])
-                self.log_warning(f"Найдены сотрудники {cont.name}: {id2s}")
-        return
+    def manage_cont(self, cont, sotr, changes):		# исчезнувший контакт: перенос на запись sotr или удаление (sotr=None)
+        if sotr is None:
+            self.log_success(f"Удаляем контакт !!! id={self.tel_id(cont)} {cont.name}")
+            changes.delete[cont.pk] = cont
+            self.contacts.pop(self.tel_id(cont), None)
+            return
+        self.log_debug(f"Найден сотрудник: id={sotr['ppl_id']}, {sotr['ppl_fio']}.")	# сотрудника перевели в другое подразделение
+        group = self.find_parent(sotr['str_id'])
+        self.check_parent('ppl', sotr['ppl_id'], sotr['str_id'], group)
+        if not self.claim_name(self.contact_names, self.unique_key(cont.group, cont.name), self.unique_key(group, cont.name)):
+            self.log_failure(f"Ошибка обновления контакта id={self.tel_id(cont)} {cont.name} grp={group}")
+            self.failed_ids['ppl'].add(self.tel_id(cont))
+            return
+        self.log_success(f"Обновляем контакт: id={self.tel_id(cont)} {cont.name} grp={cont.group} -> ID: {sotr['ppl_id']}, Parent: {sotr['str_id']}")
+        changes.touch(cont)			# запись для истории изменений
+        self.set_contact_id(cont, sotr['ppl_id'])
+        cont.group = group
+
+################################################################################
+# запись собранных изменений: по одной транзакции на тип объектов, пакетами
+
+    def apply_groups(self, commit, changes):
+        if not (commit and changes):
+            return
+        self.rescue_children(changes)
+        self.validate('str', changes, 'parent')
+        self.log_info(f"Запись групп: новых {len(changes.create)}, измененных {len(changes.update)}, удаляемых {len(changes.delete)}")
+        try:
+            with transaction.atomic():
+# новые группы - по уровням: к созданию уровня его родители уже записаны и имеют pk
+                levels = defaultdict(list)
+                for grp in changes.create:
+                    levels[self.new_depth(grp)].append(grp)
+                for depth in sorted(levels):
+                    ContactGroup.objects.bulk_create(levels[depth], batch_size=BULK_CHUNK)
+                updated = self.prepare_update(changes)
+                ContactGroup.objects.bulk_update(updated, GROUP_FIELDS, batch_size=BULK_CHUNK)
+# удаляем последними: parent удаляется каскадом, перенесенные из удаляемых групп потомки уже записаны
+                if changes.delete:
+                    ContactGroup.objects.filter(pk__in=changes.delete).delete()	# журнал пишут сигналы удаления
+                ContactGroup.objects.rebuild()			# дерево MPTT (lft/rght/level) после пакетных изменений
+                self.log_changes(changes.create, ObjectChangeActionChoices.ACTION_CREATE)
+                self.log_changes(updated, ObjectChangeActionChoices.ACTION_UPDATE)
+                search_backend.cache(changes.create + updated)	# поисковый индекс: bulk-операции не вызывают сигналы save
+        except Exception as e:
+            self.log_failure(f"Ошибка записи групп: {e}")
+            self.saved = False				# отпечатки не сохраняем - при следующем запуске всё заново
+
+# оставшиеся в удаляемых группах потомки из справочника удалились бы каскадом - переносим в корень;
+# неудачными отмечаем, чтобы при следующем запуске подразделение было сверено заново
+    def rescue_children(self, changes):
+        for grp in list(self.groups.values()):
+            if not grp.pk or grp.pk in changes.delete or grp.parent_id not in changes.delete:
+                continue
+            self.failed_ids['str'].add(self.tel_id(grp))
+            if not self.claim_name(self.group_names, self.unique_key(grp.parent_id, grp.name), self.unique_key(None, grp.name)):
+                self.log_failure(f"Группа id={self.tel_id(grp)} {grp.name} удаляется вместе с вышестоящей: такое имя уже есть в корне")
+                continue
+            self.log_warning(f"Вышестоящая группа удаляется, переносим в корень: id={self.tel_id(grp)} {grp.name}")
+            changes.touch(grp)
+            grp.parent = None
+
+    def apply_contacts(self, commit, changes):
+        if not (commit and changes):
+            return
+        self.validate('ppl', changes, 'group')
+        self.log_info(f"Запись контактов: новых {len(changes.create)}, измененных {len(changes.update)}, удаляемых {len(changes.delete)}")
+        try:
+            with transaction.atomic():
+                if changes.delete:
+                    Contact.objects.filter(pk__in=changes.delete).delete()	# журнал пишут сигналы удаления
+                Contact.objects.bulk_create(changes.create, batch_size=BULK_CHUNK)
+                updated = self.prepare_update(changes)
+                Contact.objects.bulk_update(updated, CONTACT_FIELDS, batch_size=BULK_CHUNK)
+                self.log_changes(changes.create, ObjectChangeActionChoices.ACTION_CREATE)
+                self.log_changes(updated, ObjectChangeActionChoices.ACTION_UPDATE)
+                search_backend.cache(changes.create + updated)
+        except Exception as e:
+            self.log_failure(f"Ошибка записи контактов: {e}")
+            self.saved = False
+
+# проверка полей до пакетной записи: ошибочный объект (и новые группы под ним) пропускается,
+# а не откатывает запись всех объектов этого типа. Ссылку на группу не проверяем - это запрос на каждый объект
+    def validate(self, kind, changes, parent_field):
+        dropped = set()				# id() отброшенных новых объектов
+
+        def valid(obj):
+            parent = getattr(obj, parent_field)
+            try:
+                if parent is not None and id(parent) in dropped:
+                    raise ValidationError(f"вышестоящая группа {parent.name} не записана")
+                obj.clean_fields(exclude=[parent_field])
+                return True
+            except ValidationError as e:
+                self.log_failure(f"Ошибка проверки id={self.tel_id(obj)} {obj.name}: {e}")
+            self.failed_ids[kind].add(self.tel_id(obj))
+            dropped.add(id(obj))
+            if kind == 'str' and obj.pk is None:
+                self.groups.pop(self.tel_id(obj), None)	# в несозданную группу контакты не добавляем
+            return False
+
+        changes.create = [obj for obj in changes.create if valid(obj)]	# родители раньше потомков
+        changes.update = {pk: obj for pk, obj in changes.update.items() if pk in changes.delete or valid(obj)}
+
+    def new_depth(self, grp):		# число еще не записанных предков группы
+        depth = 0
+        while grp.parent is not None and grp.parent.pk is None:
+            grp = grp.parent
+            depth += 1
+        return depth
+
+    def prepare_update(self, changes):		# изменяемые объекты (кроме удаляемых) с отметкой времени
+        now = timezone.now()
+        updated = [obj for pk, obj in changes.update.items() if pk not in changes.delete]
+        for obj in updated:
+            obj.last_updated = now			# bulk_update не обновляет auto_now поля
+        return updated
+
+    def log_changes(self, objects, action):	# журнал изменений: bulk-операции не вызывают сигналы save
+        user = getattr(self.request, 'user', None)
+        request_id = getattr(self.request, 'id', None) or uuid.uuid4()
+        records = []
+        for obj in objects:
+            record = obj.to_objectchange(action)
+            record.user = user
+            record.user_name = user.username if user else ''
+            record.request_id = request_id
+            records.append(record)
+        ObjectChange.objects.bulk_create(records, batch_size=BULK_CHUNK)
+
+class DirectoryHandler(BaseHTTPRequestHandler):
+    """Локальная подмена exp.php для замеров: отдает server.payload, с ETag и gzip."""
+
+    def do_GET(self):
+        payload, etag = self.server.payload, self.server.etag
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            payload = gzip.compress(payload, compresslevel=1)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):	# без вывода каждого запроса в stderr
+        pass
+
+
+class ContactImportBench(Script):
+    """Замеры для ContactImport на синтетическом справочнике; изменения в БД не фиксируются."""
+    mode = ChoiceVar(
+        label="Замер",
+        choices=(
+            ('index', "Поиск по выгрузке (Directory)"),
+            ('lookups', "Поиск по tel_id в БД"),
+            ('import', "Полный ContactImport"),
+        ),
+        default='index',
+        description="Что замерять",
+    )
+    sizes = StringVar(
+        label="Размеры справочника",
+        default="1000,10000,100000",
+        description="Число записей (подразделений и сотрудников) через запятую",
+    )
+    probes = IntegerVar(
+        label="Число проб",
+        default=200,
+        min_value=1,
+        description="Сколько поисков замерять линейным перебором (результат пересчитывается на весь справочник)",
+    )
+    table_size = IntegerVar(
+        label="Размер таблицы контактов",
+        default=100000,
+        min_value=1,
+        description="Недостающие до этого числа контакты создаются на время замера (без фиксации - отменяются)",
+    )
+    depth = IntegerVar(
+        label="Глубина структуры",
+        default=4,
+        min_value=1,
+        description="Число уровней дерева подразделений синтетического справочника",
+    )
+    people = IntegerVar(
+        label="Сотрудников",
+        default=10000,
+        min_value=1,
+        description="Число сотрудников синтетического справочника (подразделений - в 20 раз меньше)",
+    )
+    churn = IntegerVar(
+        label="Изменения, %",
+        default=5,
+        min_value=0,
+        max_value=100,
+        description="Доля сотрудников и подразделений, меняющихся между первым и вторым запуском",
+    )
+    query_budget = IntegerVar(
+        label="Бюджет запросов",
+        default=1000,
+        min_value=1,
+        description="Замер завершается ошибкой, если запуск импорта сделал больше SQL-запросов",
+    )
+
+    class Meta:
+        name = "Contacts import benchmark"
+        description = "Замеры ContactImport: поиск по выгрузке, поиск по tel_id в БД, полный импорт с бюджетом SQL-запросов"
+        commit_default = False
+        job_timeout = 600
+
+    def run(self, data, commit):
+        if data['mode'] in ('lookups', 'import') and commit:	# синтетические записи в БД должны откатиться
+            self.log_failure(f"Замер с записью в БД запускается только без фиксации изменений (commit)")
+            return
+        if data['mode'] == 'lookups':
+            return self.run_lookups(data['table_size'], data['probes'])
+        if data['mode'] == 'import':
+            return self.run_import(data)
+        probes = data['probes']
+        output = []
+        for size in [int(n) for n in data['sizes'].split(',')]:
+            response = self.make_directory(size)
+            ids = [random.choice(response['ppl'])['ppl_id'] for _ in range(probes)]
+            names = [random.choice(response['ppl'])['ppl_fio'] for _ in range(probes)]
+# линейный перебор, как было до индексов
+            start = time.perf_counter()
+            for ppl_id, fio in zip(ids, names):
+                next((item for item in response['ppl'] if item['ppl_id'] == ppl_id), False)
+                [item for item in response['ppl'] if item['ppl_fio'] == fio]
+            linear = (time.perf_counter() - start) / probes
+# индексы: построение один раз + поиск
+            start = time.perf_counter()
+            directory = Directory(response)
+            build = time.perf_counter() - start
+            start = time.perf_counter()
+            for ppl_id, fio in zip(ids, names):
+                directory.ppl_by_id.get(ppl_id, False)
+                directory.ppl_by_fio.get(fio, [])
+            indexed = (time.perf_counter() - start) / probes
+# полная сверка - поиск для каждой записи
+            output.append(f"{size}: linear {linear * size:.2f} s, indexed {build + indexed * size:.4f} s "
+                          f"(build {build:.4f} s), speedup x{linear * size / (build + indexed * size):.0f}")
+            self.log_info(output[-1])
+        return '\n'.join(output)
+
+# поиск контакта по tel_id: прежний запрос на вхождение JSON (custom_field_data @> ...)
+# и по выражению custom_field_data->>'tel_id', которое покрывается индексом netbox_telid_index
+    def run_lookups(self, size, probes):
+        existing = Contact.objects.count()
+        if existing < size:
+            self.log_info(f"Добавляем {size - existing} синтетических контактов")
+            Contact.objects.bulk_create([Contact(name=f'bench {i}', custom_field_data={TEL_ID: f'bench{i}'})
+                                         for i in range(size - existing)], batch_size=BULK_CHUNK)
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE tenancy_contact")	# статистика для планировщика
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'tenancy_contact' AND indexdef LIKE %s",
+                           [f"%{TEL_ID}%"])
+            indexes = [row[0] for row in cursor.fetchall()]
+        ids = list(Contact.objects.annotate(tel=KeyTextTransform(TEL_ID, 'custom_field_data'))
+                   .filter(tel__isnull=False).values_list('tel', flat=True)[:probes * 10])
+        if not ids:
+            self.log_failure(f"Нет контактов с полем '{TEL_ID}'")
+            return
+        ids = [random.choice(ids) for _ in range(probes)]
+        queries = {
+            'contains': lambda tel: Contact.objects.filter(custom_field_data__contains={TEL_ID: tel}),
+            'key_text': lambda tel: Contact.objects.annotate(tel=KeyTextTransform(TEL_ID, 'custom_field_data')).filter(tel=tel),
+        }
+        output = [f"contacts: {Contact.objects.count()}, tel_id indexes: {', '.join(indexes) or 'none'}"]
+        for name, query in queries.items():
+            start = time.perf_counter()
+            for tel in ids:
+                list(query(tel))
+            latency = (time.perf_counter() - start) / probes
+            plan = query(ids[0]).explain().splitlines()[0]
+            output.append(f"{name}: {latency * 1000:.3f} ms/lookup; plan: {plan}")
+        for line in output:
+            self.log_info(line)
+        return '\n'.join(output)
+
+# ContactImport против локального HTTP-сервера: первый запуск (всё новое), после изменений
+# churn % записей и без изменений (ожидается 304). Изменения в БД откатываются вместе со скриптом
+    def run_import(self, data):
+        response = self.make_tree(data['depth'], data['people'])
+        server = ThreadingHTTPServer(('127.0.0.1', 0), DirectoryHandler)
+        url = f'http://127.0.0.1:{server.server_port}/exp.php'
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        output = [f"depth {data['depth']}, groups {len(response['str'])}, people {len(response['ppl'])}, churn {data['churn']}%"]
+        over = []
+        try:
+            for name in ('initial', 'churn', 'unchanged'):
+                if name == 'churn':
+                    response = self.make_churn(response, data['churn'])
+                self.serve(server, response)
+                importer = ContactImport()
+                importer.request = self.request		# изменения в журнале - от имени запустившего замер
+                importer.id_prefix = BENCH_PREFIX		# настоящие группы и контакты не сверяются (не удаляются)
+                tracemalloc.start()
+                start = time.perf_counter()
+                try:
+                    importer.run({'ImportOrg': True, 'ImportPerson': True, 'API_URL': url, 'FullCheck': False}, True)
+                finally:
+                    elapsed = time.perf_counter() - start
+                    peak = max([tracemalloc.get_traced_memory()[1]] +	# phase() сбрасывает пик в начале каждой фазы
+                               [stat['peak'] for stat in getattr(importer, 'stats', {}).values()])
+                    tracemalloc.stop()
+                output.append(f"{name}: {elapsed:.2f} s, {importer.queries.count} queries, peak {peak / 2**20:.1f} MB")
+                output.append(f"    {importer.stats_text()}")
+                for line in output[-2:]:
+                    self.log_info(line)
+                if importer.queries.count > data['query_budget']:
+                    over.append(f"{name}: {importer.queries.count} > {data['query_budget']}")
+        finally:
+            server.shutdown()
+            server.server_close()
+            key = cache_key(url)		# отпечатки и валидаторы замера в кэше не нужны
+            cache.delete_many([key, key + '.digest', Fetcher(url, ()).key])
+        if over:
+            raise AbortScript(f"Превышен бюджет запросов: {'; '.join(over)}")
+        return '\n'.join(output)
+
+    def serve(self, server, response):		# новая выгрузка для локального сервера
+        server.payload = json.dumps(response, ensure_ascii=False).encode()
+        server.etag = '"' + hashlib.md5(server.payload).hexdigest() + '"'
+
+# синтетическое дерево: depth уровней, people сотрудников, подразделений в 20 раз меньше;
+# id с префиксом BENCH_PREFIX - импорт замера сверяет только их
+    def make_tree(self, depth, people):
+        groups = max(depth, people // 20)
+        org = []
+        levels = defaultdict(list)			# уровень -> id подразделений
+        for i in range(groups):
+            level = i * depth // groups			# уровни примерно поровну
+            parents = levels[level - 1]
+            org.append({'str_id': f'{BENCH_PREFIX}b{i + 1}', 'str_name': f'Bench отдел {i + 1}',
+                        'str_parent': random.choice(parents) if parents else '0', 'adres': f'Кабинет {i}', 'mail': ''})
+            levels[level].append(org[-1]['str_id'])
+        ppl = [{'str_id': random.choice(org)['str_id'], 'ppl_id': f'{BENCH_PREFIX}b{i + 1}', 'ppl_fio': f'Bench сотрудник {i + 1}',
+                'dlg_name': 'специалист', 'ppl_tel': f'{100000 + i}', 'ppl_cab': str(i % 500)} for i in range(people)]
+        return {'str': org, 'ppl': ppl}
+
+# изменения: поровну новых, удаленных, переведенных и переименованных сотрудников, переименованные подразделения
+    def make_churn(self, response, churn):
+        org = [dict(item) for item in response['str']]
+        ppl = [dict(item) for item in response['ppl']]
+        count = len(ppl) * churn // 100
+        for item in random.sample(org, len(org) * churn // 100):
+            item['str_name'] += ' (изм.)'
+        changed = random.sample(range(len(ppl)), count)
+        for n, i in enumerate(changed):
+            if n % 4 == 0:
+                ppl[i]['ppl_fio'] += ' (изм.)'
+            elif n % 4 == 1:
+                ppl[i]['str_id'] = random.choice(org)['str_id']
+            elif n % 4 == 2:
+                ppl[i]['dlg_name'] = 'ведущий специалист'
+            elif n % 4 == 3:
+                ppl[i] = None
+        ppl = [item for item in ppl if item]
+        ppl.extend({'str_id': random.choice(org)['str_id'], 'ppl_id': f'{BENCH_PREFIX}n{i + 1}', 'ppl_fio': f'Bench новый {i + 1}',
+                    'dlg_name': 'специалист', 'ppl_tel': '', 'ppl_cab': ''} for i in range(count // 4))
+        return {'str': org, 'ppl': ppl}
+
+# синтетический справочник: size подразделений и size сотрудников, имена с повторами
+    def make_directory(self, size):
+        org = [{'str_id': str(i + 1), 'str_name': f'Отдел {i % (size // 2 + 1)}', 'str_parent': str(i // 10),
+                'adres': '', 'mail': ''} for i in range(size)]
+        ppl = [{'str_id': str(i % size + 1), 'ppl_id': str(i + 1), 'ppl_fio': f'Сотрудник {i % (size // 2 + 1)}',
+                'dlg_name': 'специалист', 'ppl_tel': '', 'ppl_cab': ''} for i in range(size)]
+        return {'str': org, 'ppl': ppl}
@@ -1,13 +1,419 @@
 import nmap, socket
+import asyncio
+import base64
+import ipaddress
+import queue
+import re
+import resource
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
 import time
-from ipam.models import Prefix, IPAddress
-from extras.models import Tag
-from extras.scripts import Script, BooleanVar, StringVar, ObjectVar
+import uuid
+import xml.etree.ElementTree as ET
+import zlib
+from collections import namedtuple
+from datetime import datetime, timezone as dt_timezone
+from concurrent.futures import ThreadPoolExecutor, wait
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.utils import timezone
+from core.choices import ObjectChangeActionChoices
+from core.models import ObjectChange
+from dcim.models import Site
+from ipam.choices import PrefixStatusChoices
+from ipam.models import Prefix, IPAddress, Role, VRF
+from extras.models import Tag, CustomField
+from netbox.search.backends import search_backend
+from extras.scripts import Script, BooleanVar, StringVar, ObjectVar, IntegerVar, ChoiceVar
+
+# с 'dnspython' таймаут задается на каждый запрос, без него - только общий срок ожидания порции
+try:
+    import dns.resolver, dns.exception
+except ImportError:
+    dns = None
 
 nmap_arguments = '-sP -PE -PP -PU135,137,161 -PS22,80,135,139,443,515,3389,9100 -PA80,113,443 -T4 --send-ip --release-memory'
 #nmap_arguments = '-sn -PE -PP -PS21,22,23,25,80,113,443,31339 -PA80,113,443,10042 -T4 --source-port 53'        # рекомендовано nmap-docs
 #nmap_arguments = '-sn --send-ip -PR -PP -T2 --source-port 53'                  # длинные таймауты - находит почти всё (долго)
 
+SCAN_WORKERS = 4	# число одновременных сканирований nmap по умолчанию
+SCAN_WORKERS_MAX = 32	# верхняя граница, чтобы не перегрузить сеть и сервер
+BULK_CHUNK = 500	# размер пакета для bulk-операций с БД
+SCAN_QUEUE = 1000	# найденных адресов в очереди на запись (ограничивает память)
+TIME_BUDGET = 480	# время на сканирование за один запуск (сек), с запасом до Meta.job_timeout
+CHUNK_BITS = 8		# большие префиксы сканируются частями по 2**CHUNK_BITS адресов
+SCAN_STATE = 'scan_state'	# JSON custom field префикса: контрольная точка и история сканирований
+
+# расписание: префикс без изменений сканируется раз в SCHEDULE_MAX, а если за проход меняется
+# SCHEDULE_VOLATILE доля найденных адресов и больше - раз в SCHEDULE_MIN (между ними - по экспоненте)
+SCHEDULE_MIN = 3600		# сек
+SCHEDULE_MAX = 7 * 24 * 3600	# сек
+SCHEDULE_VOLATILE = 0.05
+SCHEDULE_ALPHA = 0.3		# вес последнего прохода в скользящей оценке изменчивости
+
+SCAN_HISTORY = 'scan_history'	# текстовый custom field префикса: битовая история активности адресов
+HISTORY_SCANS = 16		# сколько последних проходов помнить
+HISTORY_MAX_ADDRESSES = 2 ** 16	# для префиксов больше /16 история не ведется
+NMAP_PATH = shutil.which('nmap') or 'nmap'
+
+# порты TCP-проб берем те же, что и в nmap_arguments (-PS и -PA)
+TCP_PORTS = sorted({int(port) for ports in re.findall(r'-P[SA]([\d,]+)', nmap_arguments) for port in ports.split(',')})
+TCP_CONCURRENCY = 2000	# одновременных TCP-проб на весь запуск
+TCP_TIMEOUT = 1.0	# ожидание ответа на одну пробу (сек)
+
+DNS_WORKERS = 32	# одновременных PTR-запросов
+DNS_TIMEOUT = 2.0	# ожидание ответа на один запрос (сек)
+DNS_BATCH = 256		# адресов в одной порции запросов
+DNS_TTL = 3600		# время хранения найденного имени в кэше (сек)
+DNS_NEG_TTL = 600	# время хранения отсутствия PTR-записи (сек)
+DNS_CACHE_PREFIX = 'ipscan.ptr.'
+
+
+class PtrResolver:
+    """Параллельный поиск PTR-записей пулом потоков с кэшем Django (включая отрицательные ответы)."""
+
+    def __init__(self, workers=DNS_WORKERS, timeout=DNS_TIMEOUT):
+        self.timeout = timeout
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lookups = 0		# реальных обращений к DNS
+        self.hits = 0			# ответов из кэша
+        self.timeouts = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.pool.shutdown(wait=False, cancel_futures=True)	# зависшие запросы не ждем
+
+# один запрос: (имя, признак окончательного ответа для кэша)
+    def lookup(self, addr):
+        if dns:
+            try:
+                answer = dns.resolver.resolve_address(addr, lifetime=self.timeout)
+                return str(answer[0].target).rstrip('.'), True
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+                return '', True
+            except dns.exception.DNSException:
+                return '', False
+        try:
+            return socket.gethostbyaddr(addr)[0], True
+        except socket.herror:		# нет PTR-записи
+            return '', True
+        except OSError:
+            return '', False
+
+# имена для списка адресов: {адрес: имя}, пустая строка - имени нет
+    def resolve(self, addrs):
+        names = {}
+        for i in range(0, len(addrs), DNS_BATCH):
+            names.update(self.resolve_batch(addrs[i:i + DNS_BATCH]))
+        return names
+
+    def resolve_batch(self, addrs):
+        keys = {DNS_CACHE_PREFIX + addr: addr for addr in addrs}
+        names = {keys[key]: name for key, name in cache.get_many(keys).items()}
+        self.hits += len(names)
+        futures = {addr: self.pool.submit(self.lookup, addr) for addr in dict.fromkeys(addrs) if addr not in names}
+        if not futures:
+            return names
+        self.lookups += len(futures)
+# запросы идут волнами по числу потоков - столько таймаутов и ждем
+        waves = -(-len(futures) // self.workers)
+        wait(futures.values(), timeout=self.timeout * waves + 1)
+        found, missing = {}, {}
+        for addr, future in futures.items():
+            if not future.done():
+                future.cancel()
+                self.timeouts += 1
+                names[addr] = ''
+                continue
+            name, final = future.result()
+            names[addr] = name
+            if final:
+                (found if name else missing)[DNS_CACHE_PREFIX + addr] = name
+        cache.set_many(found, DNS_TTL)
+        cache.set_many(missing, DNS_NEG_TTL)
+        return names
+
+
+class QueryCounter:
+    """Счетчик SQL-запросов соединения: connection.execute_wrapper(QueryCounter())."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class LivenessHistory:
+    """Кольцо из последних depth проходов сканирования префикса: по биту на адрес в каждом проходе.
+    Хранится сжатым blob-ом в base64; индекс адреса - смещение от начала префикса."""
+    HEADER = struct.Struct('<4sBBBBI')		# сигнатура, depth, head, count, open, size
+    MAGIC = b'LVH1'
+
+    def __init__(self, size, depth=HISTORY_SCANS):
+        self.size = size
+        self.depth = depth
+        self.row = (size + 7) // 8
+        self.head = 0			# слот последнего прохода
+        self.count = 0			# заполненных слотов
+        self.open = False		# последний проход еще не завершен
+        self.stamps = [0] * depth	# время начала прохода (unix time)
+        self.bits = bytearray(depth * self.row)
+
+    @classmethod
+    def from_blob(cls, blob, size, depth=HISTORY_SCANS):
+        if blob:
+            try:
+                raw = zlib.decompress(base64.b64decode(blob))
+                magic, b_depth, head, count, is_open, b_size = cls.HEADER.unpack_from(raw)
+            except (ValueError, zlib.error, struct.error):
+                magic = None
+            if magic == cls.MAGIC and b_depth == depth and b_size == size:
+                history = cls(size, depth)
+                history.head, history.count, history.open = head, count, bool(is_open)
+                offset = cls.HEADER.size
+                history.stamps = list(struct.unpack_from(f'<{depth}I', raw, offset))
+                offset += 4 * depth
+                history.bits[:] = raw[offset:offset + depth * history.row]
+                return history
+        return cls(size, depth)		# нет истории или префикс изменился - начинаем заново
+
+    def to_blob(self):
+        raw = self.HEADER.pack(self.MAGIC, self.depth, self.head, self.count, self.open, self.size) + \
+              struct.pack(f'<{self.depth}I', *self.stamps) + bytes(self.bits)
+        return base64.b64encode(zlib.compress(raw)).decode()
+
+# новый проход; незавершенный прошлый - перезаписывается
+    def begin_scan(self, stamp):
+        if not self.open:
+            self.head = (self.head + 1) % self.depth if self.count else 0
+            self.count = min(self.count + 1, self.depth)
+        start = self.head * self.row
+        self.bits[start:start + self.row] = bytes(self.row)
+        self.stamps[self.head] = int(stamp)
+        self.open = True
+
+    def end_scan(self):
+        self.open = False
+
+    def mark(self, index):
+        if 0 <= index < self.size:
+            self.bits[self.head * self.row + index // 8] |= 1 << (index % 8)
+
+# слоты завершенных проходов, от последнего к старым
+    def completed(self):
+        ages = range(1 if self.open else 0, self.count)
+        return [(self.head - age) % self.depth for age in ages]
+
+    def alive(self, index, slot):
+        return bool(self.bits[slot * self.row + index // 8] & (1 << (index % 8)))
+
+# индексы адресов, не отвечавших ни в одном из k последних завершенных проходов
+# (пусто, если проходов меньше k - выводы делать рано)
+    def not_seen(self, k):
+        slots = self.completed()[:k]
+        if len(slots) < k:
+            return []
+        seen = 0
+        for slot in slots:
+            seen |= int.from_bytes(self.bits[slot * self.row:(slot + 1) * self.row], 'little')
+        return [index for index in range(self.size) if not seen >> index & 1]
+
+# число адресов, сменивших состояние (появились или пропали) между двумя последними завершенными проходами
+    def churn(self):
+        slots = self.completed()[:2]
+        if len(slots) < 2:
+            return 0
+        last, prev = (int.from_bytes(self.bits[slot * self.row:(slot + 1) * self.row], 'little') for slot in slots)
+        return (last ^ prev).bit_count()
+
+# время первого и последнего прохода в истории, когда адрес отвечал (None - не отвечал)
+    def first_seen(self, index):
+        return next((self.stamps[slot] for slot in reversed(self.completed()) if self.alive(index, slot)), None)
+
+    def last_seen(self, index):
+        return next((self.stamps[slot] for slot in self.completed() if self.alive(index, slot)), None)
+
+
+class DiscoveryEngine:
+    """Движок поиска активных адресов: sweep() выдает пары (адрес, имя) по мере обнаружения и заполняет stats.
+    parent - префикс, частью которого является hosts (None - hosts и есть весь префикс)."""
+    name = ''
+
+    def sweep(self, hosts, stats, parent=None):
+        raise NotImplementedError
+
+
+class NmapEngine(DiscoveryEngine):
+    """Внешний процесс nmap с разбором XML по мере вывода или через python-nmap после завершения."""
+    name = 'nmap'
+
+    def __init__(self, arguments=nmap_arguments, stream=True):
+        self.arguments = arguments
+        self.stream = stream
+
+    def sweep(self, hosts, stats, parent=None):
+        if self.stream:
+            return self.stream_subnet(hosts, stats)
+        return self.scan_subnet(hosts, stats)
+
+# сканирование подсети через python-nmap (весь результат разбирается после завершения nmap)
+    def scan_subnet(self, hosts, stats):
+        nm = nmap.PortScanner()		# у каждого потока свой сканер
+        nm.scan(hosts=hosts, arguments=self.arguments)
+        stats.update(nm.scanstats())
+        for host in nm.all_hosts():
+            yield host, nm[host].hostname()
+
+# потоковое сканирование: XML-вывод nmap разбирается по мере поступления, по одному хосту
+# stderr пишется во временный файл: непрочитанный канал при заполнении остановил бы nmap
+    def stream_subnet(self, hosts, stats):
+        stderr = tempfile.TemporaryFile()
+        proc = subprocess.Popen([NMAP_PATH, *self.arguments.split(), '-oX', '-', hosts],
+                                stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            root = None
+            try:
+                for event, elem in ET.iterparse(proc.stdout, events=('start', 'end')):
+                    if root is None:
+                        root = elem
+                    if event == 'start':
+                        continue
+                    if elem.tag == 'host':
+                        host = self.parse_host(elem)
+                        root.clear()		# разобранные хосты не храним
+                        if host:
+                            yield host
+                    elif elem.tag == 'finished':
+                        stats.update(timestr=elem.get('timestr'), elapsed=elem.get('elapsed'))
+                    elif elem.tag == 'hosts':
+                        stats.update(uphosts=elem.get('up'), downhosts=elem.get('down'), totalhosts=elem.get('total'))
+            except ET.ParseError as e:		# nmap завершился с ошибкой (или без вывода) - причина в stderr
+                proc.stdout.read()			# дочитываем вывод, чтобы nmap мог завершиться
+                proc.wait()
+                raise RuntimeError(self.read_stderr(stderr) or f'nmap XML output: {e}') from e
+            if proc.wait():
+                raise RuntimeError(self.read_stderr(stderr))
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+            stderr.close()
+
+    def read_stderr(self, stderr):
+        stderr.seek(0)
+        return stderr.read().decode(errors='replace').strip()
+
+# адрес и имя активного хоста из элемента <host>
+    def parse_host(self, elem):
+        status = elem.find('status')
+        if status is None or status.get('state') != 'up':
+            return None
+        addr = next((a.get('addr') for a in elem.iter('address') if a.get('addrtype') == 'ipv4'), None)
+        if not addr:
+            return None
+        hostname = elem.find('hostnames/hostname')
+        return addr, hostname.get('name') if hostname is not None else ''
+
+
+class TcpEngine(DiscoveryEngine):
+    """TCP connect-пробы на asyncio без внешних процессов: хост активен, если любой порт ответил (SYN-ACK или RST).
+    Имена не ищет - их дает PtrResolver при сверке."""
+    name = 'tcp'
+
+    def __init__(self, ports=TCP_PORTS, concurrency=TCP_CONCURRENCY, timeout=TCP_TIMEOUT, rate=0):
+        self.ports = ports
+        self.concurrency = concurrency	# проб одновременно в одном сканировании
+        self.timeout = timeout
+        self.rate = rate		# проб в секунду в одном сканировании (0 - без ограничения)
+
+# синхронный генератор поверх цикла asyncio: цикл крутится, пока ждем следующий активный адрес
+    def sweep(self, hosts, stats, parent=None):
+        loop = asyncio.new_event_loop()
+        found = asyncio.Queue()
+        task = loop.create_task(self.probe_all(hosts, found, stats, parent))
+        try:
+            while True:
+                addr = loop.run_until_complete(found.get())
+                if addr is None:
+                    break
+                yield addr, ''
+            loop.run_until_complete(task)	# ошибки сканирования - наружу
+        finally:
+            if not task.done():
+                task.cancel()
+                loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+            loop.close()
+
+# адреса сети и широковещательный исключаются только у всего префикса - не у каждой его части
+    async def probe_all(self, hosts, found, stats, parent=None):
+        try:
+            network = ipaddress.ip_network(hosts, strict=False)
+            parent = ipaddress.ip_network(parent, strict=False) if parent else network
+            skip = {parent.network_address, parent.broadcast_address} if parent.num_addresses > 2 else set()
+            addrs = (addr for addr in network if addr not in skip)	# общий итератор для всех корутин
+            loop = asyncio.get_running_loop()
+            interval = len(self.ports) / self.rate if self.rate else 0
+            start = next_start = loop.time()
+            up = total = 0
+
+            async def worker():
+                nonlocal up, total, next_start
+                for addr in addrs:
+                    total += 1
+                    if interval:		# равномерно распределяем пробы по времени
+                        now = loop.time()
+                        delay, next_start = next_start - now, max(now, next_start) + interval
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    if await self.probe_host(str(addr)):
+                        up += 1
+                        found.put_nowait(str(addr))
+
+            await asyncio.gather(*(worker() for _ in range(max(1, self.concurrency // len(self.ports)))))
+            stats.update(elapsed=f'{loop.time() - start:.2f}', uphosts=str(up),
+                         downhosts=str(total - up), totalhosts=str(total))
+        finally:
+            found.put_nowait(None)		# признак окончания, в том числе при ошибке
+
+# все порты хоста параллельно, до первого ответа
+    async def probe_host(self, addr):
+        probes = [asyncio.ensure_future(self.probe(addr, port)) for port in self.ports]
+        try:
+            for probe in asyncio.as_completed(probes):
+                if await probe:
+                    return True
+            return False
+        finally:
+            for probe in probes:
+                probe.cancel()
+
+    async def probe(self, addr, port):
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(addr, port), self.timeout)
+        except ConnectionRefusedError:
+            return True			# RST: порт закрыт, но хост есть
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        return True
+
+
+ENGINES = {engine.name: engine for engine in (NmapEngine, TcpEngine)}
+
+# часть префикса для одного сканирования: hosts - строка сети для движка
+ScanChunk = namedtuple('ScanChunk', ['subnet', 'index', 'hosts'])
+
+
 class IpScan(Script):
     # optional variables in UI here!
     TagBasedScanning = BooleanVar(
@@ -23,6 +429,60 @@ class IpScan(Script):
         default=1,
         description="Specify the Tag to filter Subnets to be scanned",
     )
+    select_vrf = ObjectVar(
+        model=VRF,
+        label="VRF",
+        required=False,
+        description="Scan only prefixes in this VRF",
+    )
+    select_site = ObjectVar(
+        model=Site,
+        label="Site",
+        required=False,
+        description="Scan only prefixes scoped to this site",
+    )
+    select_role = ObjectVar(
+        model=Role,
+        label="Prefix Role",
+        required=False,
+        description="Scan only prefixes with this role",
+    )
+    scan_workers = IntegerVar(
+        label="Parallel Scans",
+        default=SCAN_WORKERS,
+        min_value=1,
+        max_value=SCAN_WORKERS_MAX,
+        description="Number of prefix sweeps running at the same time",
+    )
+    scan_rate = IntegerVar(
+        label="Packets per Second",
+        default=0,
+        min_value=0,
+        required=False,
+        description="Global packet rate budget shared by all parallel sweeps (0 - unlimited)",
+    )
+    engine = ChoiceVar(
+        choices=((NmapEngine.name, 'nmap'), (TcpEngine.name, 'asyncio TCP probes')),
+        default=NmapEngine.name,
+        label="Discovery Engine",
+        description="nmap subprocess (ICMP/UDP/TCP pings) or built-in TCP connect probes to the same ports",
+    )
+    stream_results = BooleanVar(
+        label="Streaming Results",
+        default=True,
+        description="Process each host as soon as nmap reports it instead of waiting for the whole prefix",
+    )
+    scan_all = BooleanVar(
+        label="Ignore Schedule",
+        default=False,
+        description="Scan every selected prefix now instead of only those due by their change history",
+    )
+    time_budget = IntegerVar(
+        label="Time Budget",
+        default=TIME_BUDGET,
+        min_value=10,
+        description="Seconds to start new sweeps in this run; unfinished prefixes continue from a checkpoint next run",
+    )
 
     class Meta:
         name = "IP Scanner"
@@ -34,65 +494,419 @@ class IpScan(Script):
 #        self.log_debug(f"Chosen '{data['select_tag']}' tag")
         if data['TagBasedScanning'] and not data['select_tag']:
             return "Selected 'Tag Based Scanning', but tag is not chosen."
-        nm = nmap.PortScanner()
+        subnets = self.select_prefixes(data)
+        if not subnets:
+            return "No prefixes to scan."
 
-        for subnet in Prefix.objects.all():		# extracts all prefixes, in format x.x.x.x/yy:
-            s_tags = sorted([tag.name for tag in subnet.tags.all()])
-            self.log_info(f'Checking {str(subnet)}: Status is {subnet.status}; Tags is {s_tags}')
+        self.state_field = CustomField.objects.filter(name=SCAN_STATE).exists()
+        if not self.state_field:
+            self.log_warning(f"No '{SCAN_STATE}' JSON custom field for prefixes: no schedule, large prefixes restart every run")
+        self.history_field = self.state_field and CustomField.objects.filter(name=SCAN_HISTORY).exists()
+        self.states = {subnet.pk: self.load_state(subnet) for subnet in subnets}
+        self.histories = {}
+        if self.state_field and not data['scan_all']:
+            subnets = self.schedule(subnets)
+            if not subnets:
+                return "No prefixes are due for scanning."
+        workers = min(data['scan_workers'] or SCAN_WORKERS, len(subnets))
+        engine = self.make_engine(data, workers)
+        chunks = self.plan_chunks(subnets)
+        planned = sum(self.states[subnet.pk]['chunks'] - self.states[subnet.pk]['next_chunk'] for subnet in subnets)
+        self.taken = 0				# выданных на сканирование частей
+        deadline = time.monotonic() + (data['time_budget'] or TIME_BUDGET)
+        self.log_info(f'Scanning {len(subnets)} prefixes, {workers} at a time with {engine.name}')
+# сканируем части префиксов параллельно, результаты в БД пишет только основной поток
+        results = queue.Queue(maxsize=SCAN_QUEUE)
+        self.stopped = threading.Event()
+        self.queries = QueryCounter()		# считаются запросы только основного потока (соединения у потоков свои)
+        with PtrResolver() as self.resolver, ThreadPoolExecutor(max_workers=workers) as pool, \
+                connection.execute_wrapper(self.queries):
+            try:
+                self.consume(commit, pool, engine, chunks, results, workers, deadline)
+            finally:
+                self.stopped.set()		# при ошибке останавливаем сканирования, иначе пул не завершится
+        left = planned - self.taken		# считаем, а не перебираем оставшиеся части
+        if left:
+            self.log_warning(f'Time budget is over: {left} chunks left for the next run')
+        self.log_info(f'Total: {self.queries.count} DB queries; DNS: {self.resolver.lookups} lookups, '
+                      f'{self.resolver.hits} cached, {self.resolver.timeouts} timed out')
 
-            if data['TagBasedScanning'] and str(data['select_tag']) not in s_tags:	# Only scan subnets with the Tag
-#                self.log_debug(f"Scan of {subnet.prefix} NOT done (missing '{data['select_tag']}' tag)")
+# активные IPv4-префиксы с нужными меткой, VRF, сайтом и ролью - одним запросом
+    def select_prefixes(self, data):
+        prefixes = Prefix.objects.filter(status=PrefixStatusChoices.STATUS_ACTIVE, prefix__family=4)	# движки - только IPv4
+        filters = []
+        if data['TagBasedScanning']:		# Only scan subnets with the Tag
+            prefixes = prefixes.filter(tags=data['select_tag'])
+            filters.append(f"tag '{data['select_tag']}'")
+        if data.get('select_vrf'):
+            prefixes = prefixes.filter(vrf=data['select_vrf'])
+            filters.append(f"VRF '{data['select_vrf']}'")
+        if data.get('select_site'):
+            prefixes = prefixes.filter(_site=data['select_site'])	# кэшированный сайт из scope префикса
+            filters.append(f"site '{data['select_site']}'")
+        if data.get('select_role'):
+            prefixes = prefixes.filter(role=data['select_role'])
+            filters.append(f"role '{data['select_role']}'")
+# VRF нужна для поиска адресов префикса и создания новых
+        subnets = list(prefixes.select_related('vrf').order_by('vrf', 'prefix'))	# список нужен целиком: расписание и состояния
+        self.log_info(f"Selected {len(subnets)} active IPv4 prefixes{' with ' + ', '.join(filters) if filters else ''}")
+        return subnets
+
+# состояние сканирования префикса из custom field (или новое, если префикс изменился)
+    def load_state(self, subnet):
+        network = ipaddress.ip_network(str(subnet.prefix))
+        chunks = 2 ** max(0, network.max_prefixlen - CHUNK_BITS - network.prefixlen)
+        state = subnet.custom_field_data.get(SCAN_STATE) or {}
+        if state.get('chunks') != chunks:
+            state = {}
+        return {
+            'chunks': chunks,
+            'next_chunk': state.get('next_chunk', 0),	# первая несканированная часть
+            'finished': state.get('finished'),		# окончание последнего полного прохода
+            'hosts': state.get('hosts', 0),			# найдено активных адресов за последний проход
+            'changes': state.get('changes', 0),		# внесено изменений за последний проход
+            'churn': state.get('churn', 0),			# адресов, появившихся или пропавших за последний проход
+            'volatility': state.get('volatility', 1.0),	# скользящая доля изменений (новый префикс - изменчивый)
+            'pass_hosts': state.get('pass_hosts', 0),	# счетчики текущего (незавершенного) прохода
+            'pass_changes': state.get('pass_changes', 0),
+            'done': set(),
+        }
+
+# выбор префиксов, которым пора сканироваться: чем изменчивее префикс, тем короче интервал
+# порядок - по срочности: недосканированные, новые, затем по доле просроченного интервала
+    def schedule(self, subnets):
+        now = timezone.now()
+        due = []
+        for subnet in subnets:
+            state = self.states[subnet.pk]
+            if state['next_chunk'] or not state['finished']:
+                due.append((float('inf'), subnet))
                 continue
-            if str(subnet.status).lower() != 'active':		# Do not scan not working subnets
-#                self.log_debug(f'Scan of {subnet.prefix} NOT done (is not Active)')
+            interval = SCHEDULE_MAX * (SCHEDULE_MIN / SCHEDULE_MAX) ** min(1.0, state['volatility'] / SCHEDULE_VOLATILE)
+            priority = (now - datetime.fromisoformat(state['finished'])).total_seconds() / interval
+            if priority >= 1:
+                due.append((priority, subnet))
+        due.sort(key=lambda item: item[0], reverse=True)
+        self.log_info(f'Schedule: {len(due)} of {len(subnets)} prefixes are due')
+        return [subnet for _, subnet in due]
+
+# части префиксов по порядку, для недосканированных - с места остановки
+    def plan_chunks(self, subnets):
+        for subnet in subnets:
+            network = ipaddress.ip_network(str(subnet.prefix))
+            state = self.states[subnet.pk]
+            if self.history_field and network.num_addresses <= HISTORY_MAX_ADDRESSES:
+                history = LivenessHistory.from_blob(subnet.custom_field_data.get(SCAN_HISTORY), network.num_addresses)
+                if state['next_chunk'] == 0:		# начало нового прохода
+                    history.begin_scan(time.time())
+                self.histories[subnet.pk] = history
+            if state['chunks'] == 1:
+                yield ScanChunk(subnet, 0, str(network))
                 continue
-# сканируем подсеть
-            nm.scan(hosts=str(subnet), arguments=nmap_arguments)
-            self.log_debug(f'{nm.scanstats()}')
-# обрабатываем найденные активные адреса
-            for host in nm.all_hosts():
-#                self.log_debug(f'Find {host} : {nm[host].hostname()}')
-                self.update_ip(commit, f'{host}/{subnet.mask_length}', nm[host].hostname())
-# обновляем существующие адреса
-            for host in subnet.get_child_ips():
-                DNS_record = self.host_lookup(host.address)
-#                self.log_debug(f'Process {host} : {DNS_record}')
-                self.update_ip(commit, str(host.address), DNS_record)
-# пауза между сканированиями подсетей
-            time.sleep(5)
-
-# поиск имени для адреса
-    def host_lookup(self, addr):
-        a_str = str(addr).split('/')[0]
+            size = 2 ** CHUNK_BITS
+            for index in range(state['next_chunk'], state['chunks']):
+                base = int(network.network_address) + index * size
+                yield ScanChunk(subnet, index, str(ipaddress.ip_network((base, network.max_prefixlen - CHUNK_BITS))))
+
+# отметка о завершенной части; в контрольной точке - первая несканированная часть
+# по окончании прохода - итоги для расписания
+    def checkpoint(self, commit, chunk, hosts, changes):
+        state = self.states[chunk.subnet.pk]
+        state['pass_hosts'] += hosts
+        state['pass_changes'] += changes
+        state['done'].add(chunk.index)
+        while state['next_chunk'] in state['done']:
+            state['done'].discard(state['next_chunk'])
+            state['next_chunk'] += 1
+        if state['next_chunk'] >= state['chunks']:		# префикс пройден целиком
+            churn = 0
+            if chunk.subnet.pk in self.histories:
+                self.histories[chunk.subnet.pk].end_scan()
+                churn = self.histories[chunk.subnet.pk].churn()	# адреса в DHCP-пуле меняются и без записей в IPAM
+            ratio = max(state['pass_changes'], churn) / max(1, state['pass_hosts'])
+            state['volatility'] = SCHEDULE_ALPHA * ratio + (1 - SCHEDULE_ALPHA) * state['volatility'] \
+                                    if state['finished'] else ratio
+            state.update(next_chunk=0, finished=timezone.now().isoformat(),
+                         hosts=state['pass_hosts'], changes=state['pass_changes'], churn=churn, pass_hosts=0, pass_changes=0)
+        if not (commit and self.state_field):
+            return
+        subnet = chunk.subnet
+        subnet.custom_field_data[SCAN_STATE] = {key: value for key, value in state.items() if key != 'done'}
+        if subnet.pk in self.histories:
+            subnet.custom_field_data[SCAN_HISTORY] = self.histories[subnet.pk].to_blob()
+        Prefix.objects.filter(pk=subnet.pk).update(custom_field_data=subnet.custom_field_data)	# без записи в журнал изменений
+
+# движок обнаружения; общие лимиты (пакеты/сек, одновременные пробы) делятся поровну между сканированиями
+    def make_engine(self, data, workers, name=None):
+        rate = data['scan_rate']
+        if (name or data['engine']) == TcpEngine.name:
+            fd_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]	# каждая проба - открытый сокет
+            concurrency = min(TCP_CONCURRENCY, fd_limit // 2) // workers
+            return TcpEngine(concurrency=concurrency, rate=rate // workers if rate else 0)
+        return NmapEngine(self.make_arguments(rate, workers), stream=data['stream_results'])
+
+# аргументы nmap с учетом общего лимита пакетов (делится поровну между сканированиями)
+    def make_arguments(self, rate, workers):
+        if not rate:
+            return nmap_arguments
+        return f'{nmap_arguments} --max-rate {max(1, rate // workers)}'
+
+# поток сканирования: найденные адреса сразу передаются в очередь, в конце - статистика
+    def sweep(self, engine, key, hosts, results, parent=None):
+        stats = {}
+        found = engine.sweep(hosts, stats, parent)
         try:
-            res =  socket.gethostbyaddr(a_str)
-            a_name = res[0]
-        except:
-            a_name = ''
-#        self.log_debug(f'Lookup {a_str}: {a_name}')
-        return a_name
-
-# ввод/обновление данных по адресу
-    def update_ip(self, commit, ipn, name):
+            for host, hostname in found:
+                if not self.put(results, (key, host, hostname)):
+                    return
+        except Exception as e:
+            stats['error'] = str(e)
+        finally:
+            found.close()			# останавливает nmap/пробы, если сканирование прервано
+        self.put(results, (key, None, stats))	# признак окончания сканирования подсети
+
+    def put(self, results, item):
+        while not self.stopped.is_set():
+            try:
+                results.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+# запись результатов: единственный потребитель очереди, работающий с БД
+# новые сканирования запускаются по мере завершения, пока не кончилось отведенное время
+# каждый адрес части префикса (найденный и/или уже известный) ищется в DNS и обновляется не больше одного раза
+    def consume(self, commit, pool, engine, chunks, results, workers, deadline):
+        running = {}
+
+        def submit():
+            if time.monotonic() >= deadline:
+                return
+            chunk = next(chunks, None)
+            if chunk:
+                self.taken += 1
+                key = (chunk.subnet.pk, chunk.index)
+                running[key] = {'chunk': chunk, 'existing': None, 'pending': {'create': {}, 'update': {}},
+                                'live': {}, 'hosts': 0, 'changes': 0, 'queries': 0}
+                pool.submit(self.sweep, engine, key, chunk.hosts, results, str(chunk.subnet.prefix))
+
+        for _ in range(workers):
+            submit()
+        while running:
+            key, host, info = results.get()
+            entry = running[key]
+            queries = self.queries.count
+            chunk, pending = entry['chunk'], entry['pending']
+            subnet = chunk.subnet
+            if entry['existing'] is None:
+                entry['existing'] = self.load_ips(chunk)		# все адреса части префикса одним запросом
+            existing = entry['existing']
+            if host is not None:
+# найденный активный адрес: с именем от движка обрабатываем сразу, без имени - после поиска в DNS
+#                self.log_debug(f'Find {host} : {info}')
+                entry['hosts'] += 1
+                if subnet.pk in self.histories:
+                    self.histories[subnet.pk].mark(int(ipaddress.ip_address(host)) - int(subnet.prefix.network))
+                entry['live'][host] = info
+                if info:
+                    self.update_ip(subnet, existing, pending, f'{host}/{subnet.mask_length}', info)
+                    if len(pending['create']) + len(pending['update']) >= BULK_CHUNK:
+                        entry['changes'] += self.flush_ips(commit, pending)
+                entry['queries'] += self.queries.count - queries
+                continue
+            running.pop(key)
+            submit()
+            if 'error' in info:
+                for host, hostname in entry['live'].items():	# найденное до ошибки сохраняем, часть повторим в следующий раз
+                    if not hostname:
+                        self.update_ip(subnet, existing, pending, f'{host}/{subnet.mask_length}', '')
+                self.flush_ips(commit, pending)
+                self.log_failure(f'Scan of {chunk.hosts} ({str(subnet)}) failed: {info["error"]}')
+                continue
+            lookups = self.resolver.lookups
+            entry['changes'] += self.merge(commit, subnet, existing, pending, entry['live'])
+            entry['queries'] += self.queries.count - queries
+            self.log_info(f"{chunk.hosts}: {entry['hosts']} up, {entry['changes']} changes, "
+                          f"{entry['queries']} DB queries, {self.resolver.lookups - lookups} DNS lookups")
+            self.log_debug(f'{chunk.hosts}: {info}')
+            self.checkpoint(commit, chunk, entry['hosts'], entry['changes'])
+
+# слияние найденных и известных адресов части префикса по IP: каждый адрес - один раз
+# имя ищем в DNS для известных, но не ответивших, и для найденных движком без имени
+    def merge(self, commit, subnet, existing, pending, live):
+        unresolved = [key for key, ip_address in existing.items() if ip_address.pk and key not in live]
+        unresolved += [host for host, hostname in live.items() if not hostname]
+        for i in range(0, len(unresolved), DNS_BATCH):
+            batch = unresolved[i:i + DNS_BATCH]
+            names = self.resolver.resolve(batch)		# имена ищем порциями параллельно
+            for key in batch:
+                ip_address = existing.get(key)
+                ipn = str(ip_address.address) if ip_address else f'{key}/{subnet.mask_length}'
+#                self.log_debug(f'Process {ipn} : {names[key]}')
+                self.update_ip(subnet, existing, pending, ipn, names[key])
+        return self.flush_ips(commit, pending)
+
+# адреса части префикса по IP (без маски) для сверки в памяти; у префикса в VRF - и адреса без VRF
+# (прежние версии скрипта создавали все адреса глобальными), но адрес из VRF префикса важнее
+    def load_ips(self, chunk):
+        existing = {}
+        for ip_address in chunk.subnet.get_child_ips().filter(address__net_host_contained=chunk.hosts):
+            existing.setdefault(str(ip_address.address.ip), ip_address)
+        if chunk.subnet.vrf_id:
+            for ip_address in IPAddress.objects.filter(vrf__isnull=True, address__net_host_contained=chunk.hosts):
+                existing.setdefault(str(ip_address.address.ip), ip_address)
+        return existing
+
+# ввод/обновление данных по адресу (только в памяти, запись в БД - flush_ips)
+    def update_ip(self, subnet, existing, pending, ipn, name):
 #        self.log_debug(f'Processing {ipn} = {name}')
-        try:
-            ip_address = IPAddress.objects.get(address=ipn)
-#            self.log_debug(f'IP: {ip_address.address}, Name: {ip_address.dns_name}, Desc: {ip_address.description}')
-            if name and name.lower() != ip_address.dns_name:
-                self.log_success(f'Update {ipn}: {ip_address.dns_name} to {name}')
-                if commit:
-                    if ip_address.pk and hasattr(ip_address, 'snapshot'):
-                        ip_address.snapshot()
-                    ip_address.dns_name=name
-                    ip_address.full_clean()
-                    ip_address.save()
-        except IPAddress.DoesNotExist:
+        key = ipn.split('/')[0]
+        ip_address = existing.get(key)
+        if ip_address is None:
             self.log_success(f'Adding new {ipn} = {name}')
-            if commit:
-                new_address = IPAddress(
-                    address = ipn,
-                    dns_name = name,
-                    description = f'Автоматически добавлено скриптом {self.Meta.name}',
-                    )
-                new_address.full_clean()
-                new_address.save()
+            new_address = IPAddress(
+                address = ipn,
+                vrf = subnet.vrf,		# в той же VRF, что и префикс, иначе не найдем при следующей сверке
+                dns_name = name.lower(),	# bulk_create не вызывает save(), где имя приводится к нижнему регистру
+                description = f'Автоматически добавлено скриптом {self.Meta.name}',
+                )
+            existing[key] = new_address
+            pending['create'][key] = new_address
+            return
+#        self.log_debug(f'IP: {ip_address.address}, Name: {ip_address.dns_name}, Desc: {ip_address.description}')
+        if name and name.lower() != ip_address.dns_name:
+            self.log_success(f'Update {ipn}: {ip_address.dns_name} to {name}')
+            if ip_address.pk and key not in pending['update']:
+                if hasattr(ip_address, 'snapshot'):
+                    ip_address.snapshot()		# состояние до первого изменения - для истории
+                pending['update'][key] = ip_address
+            ip_address.dns_name = name.lower()
+
+# пакетная запись изменений в одной транзакции; возвращает число изменений
+    def flush_ips(self, commit, pending):
+        changes = len(pending['create']) + len(pending['update'])
+        created = self.validate_ips(pending['create'].values()) if commit else []
+        updated = self.validate_ips(pending['update'].values()) if commit else []
+        pending['create'].clear()
+        pending['update'].clear()
+        if not (created or updated):
+            return changes
+        now = timezone.now()
+        for ip_address in updated:
+            ip_address.last_updated = now		# bulk_update не обновляет auto_now поля
+        with transaction.atomic():
+            IPAddress.objects.bulk_create(created, batch_size=BULK_CHUNK)
+            IPAddress.objects.bulk_update(updated, ['dns_name', 'last_updated'], batch_size=BULK_CHUNK)
+            self.log_changes(created, ObjectChangeActionChoices.ACTION_CREATE)
+            self.log_changes(updated, ObjectChangeActionChoices.ACTION_UPDATE)
+            search_backend.cache(created + updated)	# поисковый индекс: bulk-операции не вызывают сигналы save
+        return changes
+
+    def validate_ips(self, addresses):
+        valid = []
+        for ip_address in addresses:
+            try:
+                ip_address.clean_fields()	# проверки полей без запросов к БД
+            except ValidationError as e:
+                self.log_failure(f'Invalid {ip_address.address} = {ip_address.dns_name}: {e}')
+                continue
+            valid.append(ip_address)
+        return valid
+
+# записи журнала изменений (bulk-операции не вызывают сигналы, которые их создают)
+    def log_changes(self, objects, action):
+        user = getattr(self.request, 'user', None)
+        request_id = getattr(self.request, 'id', None) or uuid.uuid4()
+        changes = []
+        for obj in objects:
+            change = obj.to_objectchange(action)
+            change.user = user
+            change.user_name = user.username if user else ''
+            change.request_id = request_id
+            changes.append(change)
+        ObjectChange.objects.bulk_create(changes, batch_size=BULK_CHUNK)
+
+
+class EngineBenchmark(IpScan):
+    """Те же префиксы, что выбрал бы IpScan, сканируются каждым движком по очереди; в БД ничего не пишется."""
+
+    class Meta:
+        name = "IP Scanner engine benchmark"
+        description = "Сравнивает движки обнаружения (nmap и asyncio TCP) на одном наборе префиксов"
+        commit_default = False
+        job_timeout = 1800
+
+    def run(self, data, commit):
+        if data['TagBasedScanning'] and not data['select_tag']:
+            return "Selected 'Tag Based Scanning', but tag is not chosen."
+        subnets = [str(subnet) for subnet in self.select_prefixes(data)]
+        if not subnets:
+            return "No prefixes to scan."
+        workers = min(data['scan_workers'] or SCAN_WORKERS, len(subnets))
+
+        found = {}
+        output = [f'{len(subnets)} prefixes, {workers} parallel sweeps', '']
+        for name in ENGINES:
+            engine = self.make_engine(data, workers, name=name)
+            start = time.monotonic()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                hosts = pool.map(lambda subnet: [host for host, _ in engine.sweep(subnet, {})], subnets)
+                found[name] = {host for subnet_hosts in hosts for host in subnet_hosts}
+            elapsed = time.monotonic() - start
+            output.append(f'{name}: {elapsed:.1f} s, {len(found[name])} hosts up')
+            self.log_info(output[-1])
+        nmap_hosts, tcp_hosts = found[NmapEngine.name], found[TcpEngine.name]
+        output.append(f'both: {len(nmap_hosts & tcp_hosts)}, nmap only: {len(nmap_hosts - tcp_hosts)}, '
+                      f'tcp only: {len(tcp_hosts - nmap_hosts)}')
+        return '\n'.join(output)
+
+
+class StaleAddresses(Script):
+    """Отчет по истории активности, которую ведет IpScan: адреса IPAM, не отвечавшие в последних проходах."""
+    select_tag = ObjectVar(
+        model=Tag,
+        query_params={},
+        label="Prefix Tag",
+        required=False,
+        description="Report only prefixes with this Tag",
+    )
+    scans = IntegerVar(
+        label="Missed Scans",
+        default=4,
+        min_value=1,
+        max_value=HISTORY_SCANS,
+        description="Address is stale if it has not answered in this many last full scans of its prefix",
+    )
+
+    class Meta:
+        name = "IP Scanner stale addresses"
+        description = "Адреса IPAM, не найденные сканером в последних проходах (по истории IP Scanner)"
+        commit_default = False
+        job_timeout = 300
+
+    def run(self, data, commit):
+        prefixes = Prefix.objects.filter(custom_field_data__has_key=SCAN_HISTORY).select_related('vrf')
+        if data['select_tag']:
+            prefixes = prefixes.filter(tags=data['select_tag'])
+        output = []
+        for subnet in prefixes.iterator(chunk_size=BULK_CHUNK):
+            network = subnet.prefix
+            history = LivenessHistory.from_blob(subnet.custom_field_data[SCAN_HISTORY], network.size)
+            stale = set(history.not_seen(data['scans']))
+            if not stale:
+                continue
+            for ip_address in subnet.get_child_ips().order_by('address'):
+                index = int(ip_address.address.ip) - int(network.network)
+                if index not in stale:
+                    continue
+                first, last = history.first_seen(index), history.last_seen(index)
+                output.append(f'{ip_address.address}\t{ip_address.dns_name}\t'
+                              f'first seen: {self.format_stamp(first)}\tlast seen: {self.format_stamp(last)}')
+        self.log_info(f"{len(output)} addresses not seen in {data['scans']} scans")
+        return '\n'.join(output)
+
+    def format_stamp(self, stamp):
+        if stamp is None:
+            return 'never'
+        return datetime.fromtimestamp(stamp, dt_timezone.utc).strftime('%Y-%m-%d %H:%M')
@@ -4,14 +4,16 @@
 # v4.1 - использовано поле VirtualMachine.serial для номера Proxmox VMid
 
 import re
+from collections import defaultdict
 import requests		# для proxmoxer и определения 'username' в http-запросе
 import socket		# для проверки соединения по IP
+from concurrent.futures import ThreadPoolExecutor
 from proxmoxer import ProxmoxAPI
 
 from django.contrib.contenttypes.models import ContentType
 
 from netbox.choices import ColorChoices
-from extras.scripts import Script, ObjectVar, FileVar
+from extras.scripts import Script, BooleanVar, ObjectVar, FileVar
 from users.models import User
 from extras.models import Tag
 from virtualization.models import ClusterType, Cluster, VirtualMachine, VMInterface
@@ -54,6 +56,28 @@ IFACE_BRIDGE_TYPE = InterfaceTypeChoices.TYPE_BRIDGE
 PVE_DEFAULT_PORT = 8006
 PBS_DEFAULT_PORT = 8007
 PROX_DEFAULT_USER = 'root@pam'	# обязательный параметр, но не используется
+PROX_PORTS = {DEVICE_ROLE_PVE: PVE_DEFAULT_PORT, DEVICE_ROLE_PBS: PBS_DEFAULT_PORT}	# сервис -> порт API, PVE важнее
+PROBE_WORKERS = 64		# одновременных проверок портов
+PROBE_TIMEOUT = 0.5		# таймаут проверки порта, сек
+API_WORKERS = 8			# одновременных запросов к API Proxmox (конфигурации гостей, qemu-агент) на ноду
+NODE_WORKERS = 8		# одновременно опрашиваемых нод кластера
+
+
+class RunRefs:
+    """Справочные объекты и константы API на один запуск: ищутся/создаются в run() один раз,
+    во внутренних циклах - без повторных запросов."""
+
+    def __init__(self, tag, manufacturer, dev_type, role_pve, role_pbs, vm_role, cluster_type, secret_role):
+        self.tag = tag
+        self.manufacturer = manufacturer
+        self.dev_type = dev_type
+        self.roles = {DEVICE_ROLE_PVE: role_pve, DEVICE_ROLE_PBS: role_pbs}	# роли устройств по сервису
+        self.vm_role = vm_role
+        self.cluster_type = cluster_type
+        self.secret_role = secret_role
+        self.ct_interface = ContentType.objects.get_for_model(Interface).pk
+        self.ct_vminterface = ContentType.objects.get_for_model(VMInterface).pk
+        self.versions = {}			# адрес хоста -> версия Proxmox (из проверки токена в connect)
 
 
 class ProxmoxImport(Script):
@@ -78,28 +102,35 @@ class ProxmoxImport(Script):
         description="Загрузите файл приватного ключа для доступа к API Proxmox",
     )
 
+    guest_details = BooleanVar(
+        label="Конфигурации ВМ",
+        default=True,
+        description="Запрашивать конфигурацию каждой ВМ (диски, интерфейсы, адреса); без этого - только состояние, CPU, память и диск из /cluster/resources",
+    )
+
 
 # проверка доступности порта
     def is_port_open(self, host, port):
         s = socket.socket()
-        s.settimeout(0.2)			# таймаут для чуть большей скорости
+        s.settimeout(PROBE_TIMEOUT)
         result = s.connect_ex((host, port))	# попытка присоединения через порт
         s.close()
         return result == 0
 
+# одновременная проверка всех пар (адрес, порт): {ip4: DEVICE_ROLE_PVE | DEVICE_ROLE_PBS | None}
+    def probe_ports(self, hosts):
+        pairs = [(host, service) for host in hosts for service in PROX_PORTS]
+        with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as pool:
+            open_ports = pool.map(lambda pair: self.is_port_open(pair[0], PROX_PORTS[pair[1]]), pairs)
+            found = {pair for pair, is_open in zip(pairs, open_ports) if is_open}
+        return {host: next((service for service in PROX_PORTS if (host, service) in found), None) for host in hosts}
+
 # установка соединения с хостом Proxmox с использованием токена
-    def connect(self, server_addr, host_dev, masterkey, secret_role):
-        if not masterkey:		# нет доступа к API
+    def connect(self, server_addr, host_dev, masterkey, secret_role, prox_service):
+        if not (masterkey and prox_service):	# нет доступа к API или прочие сервисы
             return None
         ip4 = str(server_addr).split('/')[0]
-        if self.is_port_open(ip4, PVE_DEFAULT_PORT):
-            dev_port = PVE_DEFAULT_PORT
-            prox_service = DEVICE_ROLE_PVE
-        elif self.is_port_open(ip4, PBS_DEFAULT_PORT):
-            dev_port = PBS_DEFAULT_PORT
-            prox_service = DEVICE_ROLE_PBS
-        else:
-            return None		# прочие сервисы игнорируем
+        dev_port = PROX_PORTS[prox_service]	# сервис уже определен проверкой портов
 #        self.log_debug(f"Обнаружен {prox_service} по адресу: {ip4}", host_dev)
 # секрет с нужной ролью у девайса должен быть только один
         try:
@@ -124,6 +155,7 @@ class ProxmoxImport(Script):
 #                self.log_debug(f"Proxmox realms: {realms}", host_dev)
                 try:
                     vers = api.version.get()
+                    self.refs.versions[ip4] = vers['version']
 #                    self.log_debug(f"Версия Proxmox: {vers}", host_dev)
                 except:
                     self.log_failure(f"Анализ '{host_dev.name}' невозможен: невалидный токен {prox_secret.name} !", host_dev)
@@ -421,10 +453,7 @@ class ProxmoxImport(Script):
             self.log_warning(f"Адрес привязки {ip4} для интерфейса '{iface.name}' не найден!", iface)
             return False
         real = hasattr(iface, 'mark_connected')	# 'true' только для физических интерфейсов
-        if real:
-            interface_ct = ContentType.objects.get_for_model(Interface).pk
-        else:
-            interface_ct = ContentType.objects.get_for_model(VMInterface).pk
+        interface_ct = self.refs.ct_interface if real else self.refs.ct_vminterface
         upd = (ip_address.assigned_object_type_id != interface_ct) or (ip_address.assigned_object_id != iface.id)
         if (not commit) or (not upd):
             return False
@@ -449,12 +478,12 @@ class ProxmoxImport(Script):
                     name = name,
                     status = status,
                     cluster = v_cluster,	# кластер виртуализации
-                    role = v_role if v_role else self.get_device_role(commit, name=VM_DEFAULT_ROLE, set_tag=set_tag),
+                    role = v_role if v_role else self.refs.vm_role,
                     serial = serial,
                     vcpus = cpus,
                     memory = mem,		# (MB)
                     disk = disk,		# (MB)
-                    description = description,
+                    description = description or '',	# без конфигурации гостя описания нет; Null не допускается
                     comments = f"{DESC_STR}'{self.Meta.name}'",
                     )
                 vm.full_clean()
@@ -514,16 +543,12 @@ class ProxmoxImport(Script):
 # если ничего не нашлось или адресов много - ничего не делать
     def update_vm_ip(self, commit, vdev):
 #        self.log_debug(f"VM id: {vdev.id}, '{vdev.name}'", vdev)
-        ifaces = VMInterface.objects.filter(virtual_machine=vdev.id)	# список интерфейсов ВМ
-        vm_ip_list = []
-        for iface in ifaces:
-            for ip in IPAddress.objects.filter(assigned_object_type_id=ContentType.objects.get_for_model(VMInterface).pk,
-                                            assigned_object_id=iface.id):	# собираем адреса интерфейса
-#                self.log_debug(f"VM id: {vdev.id}, IFace id: {iface.id}, IP: {ip}", ip)
-                vm_ip_list.append(str(ip))
+        ifaces = VMInterface.objects.filter(virtual_machine=vdev.id).values_list('id', flat=True)	# интерфейсы ВМ
+        vm_ip_list = list(IPAddress.objects.filter(assigned_object_type_id=self.refs.ct_vminterface,
+                                                   assigned_object_id__in=ifaces))	# адреса всех интерфейсов одним запросом
 #        self.log_debug(f"VM id: {vdev.id}, IP: {vm_ip_list}", vdev)
         if len(vm_ip_list)==1:
-            ip_prim = IPAddress.objects.get(address=vm_ip_list[0])
+            ip_prim = vm_ip_list[0]
             if commit and (vdev.primary_ip4 != ip_prim):
                 self.log_success(f"Обновляем primary адрес VM '{vdev.name}' -> {ip_prim}", vdev)
                 if vdev.pk and hasattr(vdev, 'snapshot'):
@@ -706,7 +731,7 @@ class ProxmoxImport(Script):
         if not mac_address:
             self.log_warning(f"MAC-адрес {iface_mac} для интерфейса '{iface.name}' не найден!", iface)
             return False
-        interface_ct = ContentType.objects.get_for_model(VMInterface).pk
+        interface_ct = self.refs.ct_vminterface
         upd = (mac_address.assigned_object_type_id != interface_ct) or (mac_address.assigned_object_id != iface.id)
         if (not commit):
             return not upd
@@ -727,9 +752,9 @@ class ProxmoxImport(Script):
             iface.save()
         return True
 
-    def make_dev_ifaces(self, commit, prox, node, node_dev, set_tag):
-#        self.log_debug(f"Node {node['node']}: network={prox.nodes(node['node']).network.get()}", node_dev)
-        ifaces = sorted(prox.nodes(node['node']).network.get(), key=lambda x: x['type'], reverse=True)	# интерфейсы по типу, сначала ethernet
+    def make_dev_ifaces(self, commit, network, node_dev, set_tag):
+#        self.log_debug(f"Node {node_dev.name}: network={network}", node_dev)
+        ifaces = sorted(network, key=lambda x: x['type'], reverse=True)	# интерфейсы по типу, сначала ethernet
 # перебираем интерфейсы хоста
         for iface in ifaces:
 #            self.log_debug(f"IFace {iface['iface']}: {iface}")
@@ -755,16 +780,26 @@ class ProxmoxImport(Script):
         return True
 
 # проверка и обновление PVE
-    def check_pve(self, commit, prox, host_ip, site, set_tag):
+    def check_pve(self, commit, prox, host_ip, site, set_tag, details=True):
+        version = self.refs.versions.get(str(host_ip).split('/')[0])	# версия API хоста - из connect
         dev_name=host_ip.dns_name.split('.')[0]		# выбираем хост по DNS-адресу
-        result = {'name':dev_name, 'nodes':0, 'vms':0}
+        result = {'name':dev_name, 'nodes':0, 'vms':0, 'skipped':False}
         try:
-            cluster_name=prox.cluster.status.get()[0]['name']
+            status = prox.cluster.status.get()
+            cluster_name=status[0]['name']
         except:
             self.log_warning(f"Ошибка запроса (недостаточные привилегии токена)!")
             return result
         result['name'] = cluster_name
-        cluster_type = self.get_cluster_type(commit, set_tag=set_tag)
+# кластер - по записи type='cluster' (первой в списке может быть нода); отдельный хост - по имени ноды и адресу:
+# отдельные хосты часто называются одинаково ('pve')
+        entry = next((item for item in status if item.get('type') == 'cluster'), None)
+        key = ('cluster', entry['name']) if entry else ('node', cluster_name, str(host_ip))
+        if key in self.synced_clusters:		# кластер уже обновлен через другую ноду
+            result['skipped'] = True
+            return result
+        self.synced_clusters.add(key)
+        cluster_type = self.refs.cluster_type
 #        self.log_info(f"Cluster {cluster_name}  status: {prox.cluster.status.get()}")
 #        self.log_info(f"Cluster {cluster_name} options: {prox.cluster.options.get()}")
         cluster = self.get_cluster(commit, cluster_name, cluster_type,
@@ -775,83 +810,109 @@ class ProxmoxImport(Script):
         node_list = prox.nodes().get()
         result['nodes'] = len(node_list)
         vm_count = 0
-        for node in node_list:
-#            self.log_debug(f"Node {node['node']}: {node}")
-            node_status = DeviceStatusChoices.STATUS_OFFLINE if node['status'] != 'online' else DeviceStatusChoices.STATUS_ACTIVE
-            if len(node_list)>1:
-                node_name = node['node']		# выбираем хост по имени ноды (не проверяем)
-            else:
-                node_name = dev_name
+# все гости кластера одним запросом
+        online = {node['node'] for node in node_list if node['status'] == 'online'}
+        guests_by_node = defaultdict(list)
+        for guest in prox.cluster.resources.get(type='vm'):
+            if guest['type'] in ('lxc', 'qemu') and guest['node'] in online:
+                guests_by_node[guest['node']].append(guest)
+# данные API собирают потоки - по ноде на поток, в БД пишет только основной поток, ноды - по порядку
+        with ThreadPoolExecutor(max_workers=NODE_WORKERS) as pool:
+            collected = [pool.submit(self.collect_node, prox, node, guests_by_node.get(node['node'], []), details, version)
+                         if node['status'] == 'online' else None for node in node_list]
+            for node, future in zip(node_list, collected):
+                vm_count += self.apply_node(commit, node, future.result() if future else None,
+                                            cluster, len(node_list), dev_name, host_ip, site, set_tag, details)
+        result['vms'] = vm_count
+        return result
+
+# сбор данных ноды из API (в потоке, без обращений к БД): сеть, конфигурации гостей
+    def collect_node(self, prox, node, guests, details, version):
+        record = {'network': None, 'version': version, 'guests': [], 'error': None}
+        try:
+            record['network'] = prox.nodes(node['node']).network.get()
+        except Exception as e:
+            record['error'] = str(e)
+# гости нод - в порядке прежнего перебора: сначала контейнеры, потом вирт.машины
+        guests = sorted(guests, key=lambda guest: (guest['type'] != 'lxc', guest['vmid']))
+        configs = self.fetch_guest_configs(prox, guests) if details else {}
+        record['guests'] = [(guest,) + configs.get(guest['id'], (None, None)) for guest in guests]
+        return record
+
+# запись собранных данных ноды в Netbox; record=None - нода не в сети. Возвращает число гостей
+    def apply_node(self, commit, node, record, cluster, node_count, dev_name, host_ip, site, set_tag, details):
+#        self.log_debug(f"Node {node['node']}: {node}")
+        node_status = DeviceStatusChoices.STATUS_OFFLINE if node['status'] != 'online' else DeviceStatusChoices.STATUS_ACTIVE
+        if node_count>1:
+            node_name = node['node']		# выбираем хост по имени ноды (не проверяем)
+        else:
+            node_name = dev_name
 # ищем устройство (создаем, если их несколько в кластере)
-            node_dev = self.get_device(commit, name=node_name, site=site,
-                                        d_role=self.get_device_role(commit, name=DEVICE_ROLE_PVE, set_tag=set_tag),
-                                        d_type=self.get_device_type(commit, set_tag=set_tag),
-                                        v_cluster=cluster, status=node_status, set_tag=set_tag)
-            if node['status'] != 'online':		# не работает нода в кластере ?
-                continue
-#            self.log_debug(f"Node {node['node']}: status={prox.nodes(node['node']).status.get()}", node_dev)
-            self.make_dev_ifaces(commit, prox, node, node_dev, set_tag=set_tag)
-# теперь обновляем хост (если нода 'online')
-            self.update_device(commit, node_dev, ip4=host_ip if node_name==dev_name else None,
-                            d_role=self.get_device_role(False, name=DEVICE_ROLE_PVE),
-                            v_cluster=cluster, status=node_status,
-                            description=f"Proxmox VE {prox.version.get()['version']}, cpu={node['maxcpu']}, mem={int(int(node['maxmem'])/1024**3)} GiB")
-
-# перебираем вирт.контейнеры
-            for vm in prox.nodes(node['node']).lxc.get():
-                vm_count += 1
-#                self.log_debug(f"LXC {vm['name']}: {vm}")
-                vm_stat = VirtualMachineStatusChoices.STATUS_ACTIVE if vm['status'] == 'running' else VirtualMachineStatusChoices.STATUS_OFFLINE
-                vm_conf = prox.nodes(node['node']).lxc(vm['vmid']).config.get()
-#                self.log_debug(f"Conf {vm['name']}: {vm_conf}")
-                descr = f"VM тип=LXC, OStype={vm_conf['ostype']}"
-# делаем/обновляем ВМ
-                nvm = self.get_vm(commit, vm['name'], vm_stat, cluster, serial=vm['vmid'],
-                                cpus=vm['cpus'], mem=int(vm_conf['memory']), disk=self.calc_disks(vm_conf),
-                                set_tag=set_tag, description=descr)
-                if not nvm:		# не удалось создать?
-                    continue
-# создаем/обновляем интерфейсы ВМ
-                net_device_id = 0
-                while f'net{net_device_id}' in vm_conf:
-                    self.make_vm_iface(commit, nvm, f'net{net_device_id}', vm_conf[f'net{net_device_id}'], set_tag=set_tag)
-                    net_device_id += 1
-# теперь обновляем IP у ВМ
-                self.update_vm_ip(commit, nvm)
-
-# перебираем вирт.машины
-            for vm in prox.nodes(node['node']).qemu.get():
-                vm_count += 1
-                vm_conf = prox.nodes(node['node']).qemu(vm['vmid']).config.get()
-#                self.log_debug(f"QEMU {vm['name']}: {vm}")
-#                self.log_debug(f"Conf {vm['name']}: {vm_conf}")
-#                self.log_debug(f"Stat {vm['name']}: {prox.nodes(node['node']).qemu(vm['vmid']).status.current.get()}")
-                if vm['status'] == 'running':
-                    vm_stat = VirtualMachineStatusChoices.STATUS_ACTIVE
-                    try:
-                        vm_netinfo = prox.nodes(node['node']).qemu(vm['vmid']).agent.get('network-get-interfaces') if 'agent' in vm_conf and vm_conf['agent'] else None
-                    except:
-                        vm_netinfo = None
-                else:
-                    vm_stat = VirtualMachineStatusChoices.STATUS_OFFLINE
+        node_dev = self.get_device(commit, name=node_name, site=site,
+                                    d_role=self.refs.roles[DEVICE_ROLE_PVE],
+                                    d_type=self.refs.dev_type,
+                                    v_cluster=cluster, status=node_status, set_tag=set_tag)
+        if record is None:			# не работает нода в кластере ?
+            return 0
+        if record['error']:
+            self.log_warning(f"Ошибка запроса данных ноды '{node['node']}': {record['error']}", node_dev)
+        else:
+            self.make_dev_ifaces(commit, record['network'], node_dev, set_tag=set_tag)
+# теперь обновляем хост (если нода 'online'); от сетевых данных ноды зависят только интерфейсы
+        self.update_device(commit, node_dev, ip4=host_ip if node_name==dev_name else None,
+                        d_role=self.refs.roles[DEVICE_ROLE_PVE],
+                        v_cluster=cluster, status=node_status,
+                        description=f"Proxmox VE {record['version']}, cpu={node['maxcpu']}, mem={int(int(node['maxmem'])/1024**3)} GiB")
+        for guest, vm_conf, vm_netinfo in record['guests']:
+            if details and not vm_conf:
+                self.log_warning(f"Не получена конфигурация {guest['type']} {guest['vmid']} '{guest['name']}', обновляем по /cluster/resources", node_dev)
+            self.update_guest(commit, cluster, guest, vm_conf, vm_netinfo, set_tag)
+        return len(record['guests'])
+
+# конфигурации гостей и сетевые данные qemu-агента (для работающих ВМ с агентом):
+# одновременно, не больше API_WORKERS запросов. {id гостя: (config, netinfo)}, при ошибке - (None, None)
+    def fetch_guest_configs(self, prox, guests):
+        def fetch(guest):
+            api = prox.nodes(guest['node'])(guest['type'])(guest['vmid'])
+            try:
+                vm_conf = api.config.get()
+            except:
+                return None, None
+            vm_netinfo = None
+            if guest['type'] == 'qemu' and guest['status'] == 'running' and vm_conf.get('agent'):
+                try:
+                    vm_netinfo = api.agent.get('network-get-interfaces')
+                except:
                     vm_netinfo = None
-#                self.log_debug(f"Info {vm['name']}: {vm_netinfo}")
-                descr = f"VM тип=QEMU, OStype={vm_conf['ostype']}"
+            return vm_conf, vm_netinfo
+        with ThreadPoolExecutor(max_workers=API_WORKERS) as pool:
+            return dict(zip([guest['id'] for guest in guests], pool.map(fetch, guests)))
+
+# создание/обновление гостя (LXC или QEMU) по записи /cluster/resources и конфигурации (если есть)
+    def update_guest(self, commit, cluster, guest, vm_conf, vm_netinfo, set_tag):
+#        self.log_debug(f"{guest['type']} {guest['name']}: {guest}")
+        vm_stat = VirtualMachineStatusChoices.STATUS_ACTIVE if guest['status'] == 'running' else VirtualMachineStatusChoices.STATUS_OFFLINE
+        if vm_conf:
+            mem = int(vm_conf['memory'])
+            disk = self.calc_disks(vm_conf)
+            descr = f"VM тип={'LXC' if guest['type'] == 'lxc' else 'QEMU'}, OStype={vm_conf.get('ostype')}"
+        else:			# только данные /cluster/resources (в байтах)
+            mem = int(guest['maxmem']) // 1024**2
+            disk = int(guest['maxdisk']) // 1000**2	# Netbox считает диски в МБ, размеры дисков Proxmox - в десятичных единицах
+            descr = None		# у существующей ВМ описание не трогаем, новая создается с пустым
 # делаем/обновляем ВМ
-                nvm = self.get_vm(commit, vm['name'], vm_stat, cluster, serial=vm['vmid'],
-                                cpus=vm['cpus'], mem=int(vm_conf['memory']), disk=self.calc_disks(vm_conf),
-                                set_tag=set_tag, description=descr)
-                if not nvm:		# не удалось создать?
-                    continue
+        nvm = self.get_vm(commit, guest['name'], vm_stat, cluster, serial=guest['vmid'],
+                        cpus=guest['maxcpu'], mem=mem, disk=disk, set_tag=set_tag, description=descr)
+        if not (nvm and vm_conf):	# не удалось создать или без конфигурации?
+            return nvm
 # создаем/обновляем интерфейсы ВМ
-                net_device_id = 0
-                while f'net{net_device_id}' in vm_conf:
-                    self.make_vm_iface(commit, nvm, f'net{net_device_id}', vm_conf[f'net{net_device_id}'], net_info=vm_netinfo, set_tag=set_tag)
-                    net_device_id += 1
+        net_device_id = 0
+        while f'net{net_device_id}' in vm_conf:
+            self.make_vm_iface(commit, nvm, f'net{net_device_id}', vm_conf[f'net{net_device_id}'], net_info=vm_netinfo, set_tag=set_tag)
+            net_device_id += 1
 # теперь обновляем IP у ВМ
-                self.update_vm_ip(commit, nvm)
-        result['vms'] = vm_count
-        return result
+        self.update_vm_ip(commit, nvm)
+        return nvm
 
 # проверка и обновление PBS
     def check_pbs(self, commit, prox, node_dev, host_ip, set_tag):
@@ -863,10 +924,10 @@ class ProxmoxImport(Script):
             self.log_warning(f"Ошибка запроса (недостаточные привилегии токена)!")
             return {'name':node_dev.name}
 #        self.log_debug(f"Node {node['node']}: {node_status}", node_dev)
-        self.make_dev_ifaces(commit, prox, node, node_dev, set_tag=set_tag)
+        self.make_dev_ifaces(commit, prox.nodes(node['node']).network.get(), node_dev, set_tag=set_tag)
 # теперь обновляем хост (статус делаем 'online')
-        self.update_device(commit, node_dev, d_role=self.get_device_role(False, name=DEVICE_ROLE_PBS), ip4=host_ip,
-                description=f"Proxmox BS {prox.version.get()['version']}, cpu={node_status['cpuinfo']['cpus']}, mem={int(int(node_status['memory']['total'])/1024**3)} GiB")
+        self.update_device(commit, node_dev, d_role=self.refs.roles[DEVICE_ROLE_PBS], ip4=host_ip,
+                description=f"Proxmox BS {self.refs.versions.get(str(host_ip).split('/')[0])}, cpu={node_status['cpuinfo']['cpus']}, mem={int(int(node_status['memory']['total'])/1024**3)} GiB")
         return {'name':node_dev.name}
 
 ################################################################################
@@ -890,6 +951,8 @@ class ProxmoxImport(Script):
                 script_dev_role_pve and script_dev_role_pbs and script_vm_role and script_cluster_type):
             self.log_warning(f"Не созданы необходимые для работы объекты!")
             return
+        self.refs = RunRefs(script_tag, script_manuf, script_dev_type, script_dev_role_pve, script_dev_role_pbs,
+                            script_vm_role, script_cluster_type, script_s_role)
 
         if script_s_role:
 # Получаем UserKey для текущего пользователя из плагина 'netbox_secrets'
@@ -920,25 +983,27 @@ class ProxmoxImport(Script):
 
 # составляем список проверяемых адресов
         ip_list = []
-        for subnet in Prefix.objects.all():
-            if TAG_AUTO in [tag.name for tag in subnet.tags.all()]:	# только помеченные префиксы
-                ip_list.extend(subnet.get_child_ips())
+        for subnet in Prefix.objects.filter(tags__name=TAG_AUTO):	# только помеченные префиксы - одним запросом
+            ip_list.extend(subnet.get_child_ips())
         if len(ip_list)==0:
             self.log_warning(f"Не найдено адресов для сканирования в отмеченных подсетях!")
             return
         self.log_info(f"Проверяем IP: {ip_list[0]} - {ip_list[-1]}")
 
+# проверяем порты Proxmox сразу у всех активных адресов
+        ip_list = [addr for addr in ip_list if str(addr.status).lower() == 'active']
+        services = self.probe_ports([str(addr).split('/')[0] for addr in ip_list])
+        self.log_info(f"Проверено адресов: {len(ip_list)}, PVE: {list(services.values()).count(DEVICE_ROLE_PVE)}, "
+                      f"PBS: {list(services.values()).count(DEVICE_ROLE_PBS)}")
+
 # основной цикл - перебираем адреса
+        self.synced_clusters = set()	# кластеры PVE, обновленные в этом запуске: ('cluster', имя) или ('node', имя, адрес)
+        skipped = 0			# адреса нод уже обновленных кластеров
         for addr in ip_list:
-            if str(addr.status).lower() != 'active':	# все активные адреса из списка
-                continue
             s_name=addr.dns_name.split('.')[0]		# выбираем хост по DNS-адресу
-# проверяем порты Proxmox
-            ip4 = str(addr).split('/')[0]
-            if self.is_port_open(ip4, PVE_DEFAULT_PORT):
-                dev_role = script_dev_role_pve
-            elif self.is_port_open(ip4, PBS_DEFAULT_PORT):
-                dev_role = script_dev_role_pbs
+            service = services[str(addr).split('/')[0]]
+            if service:
+                dev_role = self.refs.roles[service]
             else:
 # ищем в базе устройство
                 s_dev = self.get_device(False, name=s_name, site=def_site)
@@ -954,17 +1019,27 @@ class ProxmoxImport(Script):
                 continue
 # обновляем устройство
             self.update_device(commit, s_dev, d_role=dev_role, status=DeviceStatusChoices.STATUS_ACTIVE)
+            if service == DEVICE_ROLE_PVE and s_dev.cluster and ('cluster', s_dev.cluster.name) in self.synced_clusters:
+                self.log_info(f"Кластер '{s_dev.cluster.name}' уже обновлен, пропускаем адрес {str(addr)}", s_dev)
+                self.update_device(commit, s_dev, ip4=addr)
+                skipped += 1
+                continue
 # пытаемся подключиться к Proxmox
-            prox = self.connect(addr, s_dev, m_key, script_s_role)
+            prox = self.connect(addr, s_dev, m_key, self.refs.secret_role, service)
             if not prox:
                 continue
 # смотрим инфу Proxmox и обновляем хосты, интерфейсы, ВМ и прочее
-            prox_version = prox.version.get()['version']
+            prox_version = self.refs.versions.get(str(addr).split('/')[0])
             self.log_info(f"Анализ {prox._backend.auth.service} {prox_version} по адресу: {str(addr)}")
             if prox._backend.auth.service==DEVICE_ROLE_PVE:
-                p_stat = self.check_pve(commit, prox, addr, site=def_site, set_tag=script_tag)
+                p_stat = self.check_pve(commit, prox, addr, site=def_site, set_tag=script_tag, details=data['guest_details'])
+                if p_stat['skipped']:
+                    self.log_info(f"Кластер '{p_stat['name']}' уже обновлен, пропускаем адрес {str(addr)}", s_dev)
+                    skipped += 1
+                    continue
                 self.log_success(f"Анализ PVE '{p_stat['name']}' по адресу: {str(addr)} завершен. Nodes: {p_stat['nodes']}, VMs: {p_stat['vms']}", s_dev)
             else:
                 p_stat = self.check_pbs(commit, prox, s_dev, addr, set_tag=script_tag)
                 self.log_success(f"Анализ PBS '{p_stat['name']}' по адресу: {str(addr)} завершен.", s_dev)
+        self.log_info(f"Обновлено кластеров PVE: {len(self.synced_clusters)}, пропущено повторов через другие ноды: {skipped}")
         return